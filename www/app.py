@@ -3,12 +3,15 @@ import logging
 from jinja2 import Environment, FileSystemLoader
 
 from www.coroweb import add_routes, add_static
+# 与 models.py 一样按 orm 导入，保证和 Model 使用的是同一个模块
+from orm import close_pool, loader_scope
+import serializers
+from httpcache import response_cache
+from compression import compress_response, compressible
 
 logging.basicConfig(level=logging.INFO)
 import asyncio, os, time
 
-import json
-
 from datetime import datetime
 from aiohttp import web
 
@@ -42,6 +45,9 @@ def init_jinja2(app, **kw):
         for name, f in filters.items():
             # filters是Environment类的属性：过滤器字典
             env.filters[name] = f
+    # 全局函数，如 static_url（见 coroweb.add_static）
+    for name, f in kw.get('globals', dict()).items():
+        env.globals[name] = f
     # 所有的一切是为了给app添加__templating__字段
     # 前面将jinja2的环境配置都赋值给env了，这里再把env存入app的dict中，这样app就知道要到哪儿去找模板，怎么解析模板。
     app['__template__'] = env  # app是一个dict-like对象
@@ -71,6 +77,38 @@ async def logger_factory(app, handler):
     return logger
 
 
+# 压缩文本响应（见 compression.py），放在 cache_factory 外层，缓存的是未压缩的响应
+async def compression_factory(app, handler):
+    async def compression(request):
+        return await compress_response(request, await handler(request))
+
+    return compression
+
+
+# 为每个请求开启 Model.find 的批量合并（见 orm.loader_scope）
+async def loader_factory(app, handler):
+    async def loader(request):
+        with loader_scope():
+            return await handler(request)
+
+    return loader
+
+
+# 缓存 @cached 视图的GET响应，带 ETag，If-None-Match 命中时返回304（见 httpcache.py）
+# 放在 response_factory 外层，缓存的是构造好的响应
+async def cache_factory(app, handler):
+    async def cache(request):
+        if request.method != 'GET':
+            return await handler(request)
+        # 路由注册的是 RequestHandler.__call__，见 coroweb.add_route
+        policy = getattr(getattr(request.match_info.handler, '__self__', None), 'cache_policy', None)
+        if policy is None:
+            return await handler(request)
+        return await response_cache.fetch(request, handler, policy)
+
+    return cache
+
+
 # 处理视图函数返回值，制作response的middleware
 # 请求对象request的处理工序：
 #              logger_factory => response_factory => RequestHandler().__call__ => handler
@@ -85,6 +123,9 @@ async def response_factory(app, handler):
         logging.info('response result = %s' % str(r))
         if isinstance(r, web.StreamResponse):  # StreamResponse是所有Response对象的父类
             return r  # 无需构造，直接返回
+        # 异步迭代器（如 serializers.json_array(Blog.iter_all())），边生成边分块发送
+        if hasattr(r, '__aiter__'):
+            return await stream_response(request, r)
         if isinstance(r, bytes):
             logging.info('*' * 10)
             resp = web.Response(body=r)  # 继承自StreamResponse，接受body参数，构造HTTP响应内容
@@ -102,17 +143,14 @@ async def response_factory(app, handler):
             # 在后续构造视图函数返回值时，会加入__template__值，用以选择渲染的模板
             template = r.get('__template__', None)
             if template is None:  # 不带模板信息，返回json对象
-                resp = web.Response(
-                    body=json.dumps(r, ensure_ascii=False, default=lambda obj: obj.__dict__).encode('utf-8'))
-                # ensure_ascii：默认True，仅能输出ascii格式数据。故设置为False。
-                # default：r对象会先被传入default中的函数进行处理，然后才被序列化为json对象
-                # __dict__：以dict形式返回对象属性和值的映射
+                # 直接生成utf-8的bytes，有 orjson 时使用 orjson，见 serializers.py
+                resp = web.Response(body=serializers.dumps(r))
                 resp.content_type = 'application/json;charset=utf-8'
                 return resp
             else:  # 带模板信息，渲染模板
                 # app['__templating__']获取已初始化的Environment对象，调用get_template()方法返回Template对象
                 # 调用Template对象的render()方法，传入r渲染模板，返回unicode格式字符串，将其用utf-8编码
-                resp = web.Response(body=app['__template__'].get_template(template).render(**r))
+                resp = web.Response(body=app['__template__'].get_template(template).render(**r).encode('utf-8'))
                 resp.content_type = 'text/html;charset=utf-8'  # utf-8编码的html格式
                 return resp
         # 返回响应码
@@ -131,6 +169,32 @@ async def response_factory(app, handler):
     return response
 
 
+async def stream_response(request, chunks):
+    """
+    把异步迭代器的输出以 chunked 编码发送，不在内存中拼接完整的响应
+    :param chunks: 产出 bytes 或 str 的异步迭代器，可带 content_type 属性
+    """
+    resp = web.StreamResponse()
+    resp.content_type = getattr(chunks, 'content_type', 'application/octet-stream')
+    resp.enable_chunked_encoding()
+    if compressible(resp.content_type):
+        # 流式响应由 aiohttp 边发送边压缩
+        resp.enable_compression()
+    await resp.prepare(request)
+    async for chunk in chunks:
+        if isinstance(chunk, str):
+            chunk = chunk.encode('utf-8')
+        # write() 在发送缓冲区满时等待，生成速度不会超过客户端接收速度
+        await resp.write(chunk)
+    await resp.write_eof()
+    return resp
+
+
+# 关闭时写入 Model.incr 缓冲的计数，并关闭数据库连接池
+async def close_db(app):
+    await close_pool()
+
+
 def index(request):
     return web.Response(body=b'<h1>Awesome</h1>', content_type='text/html')  # 此处content_type添加后正常访问，不添加则下载文件
 
@@ -147,19 +211,17 @@ async def init():
 
 
 if __name__ == '__main__':
-    # loop = asyncio.get_event_loop()
-    # loop.run_until_complete(init())
-    # loop.run_forever()
-    async def init(loop):
-        app = web.Application(loop=loop, middlewares=[logger_factory, response_factory])
-        init_jinja2(app, filters=dict(datetime=datetime_filter))
-        add_routes(app, 'test_view')
-        add_static(app)
-        srv = await loop.create_server(app.make_handler(), 'localhost', 9000)
-        logging.info('server started at http://127.0.0.1:9000...')
-        return srv
-
-
-    loop = asyncio.get_event_loop()
-    loop.run_until_complete(init(loop))
-    loop.run_forever()
+    async def init():
+        app = web.Application(middlewares=[logger_factory, compression_factory, loader_factory,
+                                           cache_factory, response_factory])
+        assets = add_static(app)
+        init_jinja2(app, filters=dict(datetime=datetime_filter), globals=dict(static_url=assets.url))
+        app.on_shutdown.append(close_db)
+        # 部署时用 python coroweb.py routes.json test_view 生成路由清单，启动时不导入视图模块
+        add_routes(app, 'test_view', manifest=os.environ.get('ROUTE_MANIFEST'))
+        return app
+
+
+    # run_app 在 Ctrl-C/SIGTERM 时会执行 app.shutdown()，on_shutdown 中的 close_db 写入 Model.incr 缓冲的计数
+    # 直接用 loop.create_server(app.make_handler()) + run_forever() 时 on_shutdown 不会被调用
+    web.run_app(init(), host='localhost', port=9000)
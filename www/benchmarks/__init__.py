@@ -0,0 +1,119 @@
+import argparse
+import asyncio
+import gc
+import json
+import time
+import tracemalloc
+
+"""
+微基准测试的公共部分：计时、内存分配统计、与基线结果对比
+在 www 目录下运行，如：python -m benchmarks.bench_orm --save baseline.json
+"""
+
+_loop = None
+
+
+def run_sync(coro):
+    """
+    在基准测试共用的事件循环中执行协程
+    """
+    global _loop
+    if _loop is None:
+        _loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(_loop)
+    return _loop.run_until_complete(coro)
+
+
+def measure(fn, ops, repeat=3):
+    """
+    :param fn: 被测函数，可以是协程函数
+    :param ops: 每次调用 fn 包含的操作数，用来换算 ops/sec
+    :param repeat: 重复次数，取最快的一次
+    :return: dict(ops, best, ops_per_sec, alloc_kb, peak_kb)
+    """
+    if asyncio.iscoroutinefunction(fn):
+        run = lambda: run_sync(fn())
+    else:
+        run = fn
+    run()  # 预热，填充各种缓存
+    best = None
+    for _ in range(repeat):
+        gc.collect()
+        start = time.perf_counter()
+        run()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    # 单独跑一次统计内存分配，tracemalloc 会拖慢执行，不参与计时
+    gc.collect()
+    tracemalloc.start()
+    run()
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return dict(ops=ops, best=best, ops_per_sec=ops / best if best else float('inf'),
+                alloc_kb=current / 1024, peak_kb=peak / 1024)
+
+
+def report(results, baseline=None):
+    """
+    打印结果表格，给出基线时同时打印变化比例
+    :param results: {用例名: measure() 的结果}
+    :param baseline: 基线结果，格式同 results
+    """
+    print('%-40s %14s %12s %12s %10s' % ('case', 'ops/sec', 'alloc KB', 'peak KB', 'vs base'))
+    for name, r in results.items():
+        change = ''
+        if baseline and name in baseline:
+            change = '%+.1f%%' % ((r['ops_per_sec'] / baseline[name]['ops_per_sec'] - 1) * 100)
+        print('%-40s %14.0f %12.1f %12.1f %10s' % (name, r['ops_per_sec'], r['alloc_kb'], r['peak_kb'], change))
+
+
+def compare(results, baseline, tolerance=0.2):
+    """
+    :param tolerance: 允许的 ops/sec 下降比例
+    :return: 退化的用例名列表
+    """
+    regressions = []
+    for name, r in results.items():
+        base = baseline.get(name)
+        if base and r['ops_per_sec'] < base['ops_per_sec'] * (1 - tolerance):
+            regressions.append(name)
+    return regressions
+
+
+def main(cases, argv=None, description=None):
+    """
+    命令行入口
+    :param cases: 函数，参数为规模，返回 [(用例名, 被测函数, 操作数)]
+    :return: 退出码，有退化时为1
+    """
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument('--scales', default='1000,100000',
+                        help='comma separated row counts, e.g. 1000,100000,1000000')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--filter', default=None, help='only run cases whose name contains this string')
+    parser.add_argument('--save', default=None, help='write results to this baseline file')
+    parser.add_argument('--compare', default=None, help='compare against this baseline file')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed ops/sec drop before failing')
+    args = parser.parse_args(argv)
+
+    results = dict()
+    for scale in [int(n) for n in args.scales.split(',')]:
+        for name, fn, ops in cases(scale):
+            name = '%s[%s]' % (name, scale)
+            if args.filter and args.filter not in name:
+                continue
+            results[name] = measure(fn, ops, args.repeat)
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    report(results, baseline)
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if baseline:
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print('regressions (> %d%% slower): %s' % (args.tolerance * 100, ', '.join(regressions)))
+            return 1
+    return 0
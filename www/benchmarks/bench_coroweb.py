@@ -0,0 +1,138 @@
+import sys
+from urllib import parse
+
+from benchmarks import main
+from coroweb import RequestHandler, compile_binder, get, get_named_kwargs, get_required_kwargs, \
+    has_named_kwarg, has_request_arg, has_var_kwarg
+
+"""
+coroweb 每个请求的参数绑定开销：注册时编译的 compile_binder 与原来在 __call__ 中逐项处理的写法对比
+用假的 request 对象，不需要启动服务
+用法（在 www 目录下）：
+    python -m benchmarks.bench_coroweb --scales 10000,100000
+"""
+
+
+class FakeRequest(object):
+    """
+    只实现参数绑定用到的属性，query 与 aiohttp 一样只解析一次
+    """
+
+    def __init__(self, method='GET', query_string='', match_info=None, body=None, content_type=''):
+        self.method = method
+        self.query_string = query_string
+        self.query = dict((k, v[0]) for k, v in parse.parse_qs(query_string, True).items())
+        self.match_info = match_info or dict()
+        self.content_type = content_type
+        self._body = body
+
+    async def json(self):
+        return self._body
+
+    async def post(self):
+        return self._body
+
+
+@get('/api/blogs')
+async def api_blogs(*, page: int = 1):
+    return page
+
+
+@get('/blog/{id}')
+async def get_blog(id, request):
+    return id
+
+
+@get('/api/search')
+async def api_search(request, *, q, page='1', **kw):
+    return q
+
+
+class LegacyHandler(object):
+    """
+    原 RequestHandler 的参数处理，作为对照
+    """
+
+    def __init__(self, fn):
+        self.has_request_arg = has_request_arg(fn)
+        self.has_var_kwarg = has_var_kwarg(fn)
+        self.has_named_kwarg = has_named_kwarg(fn)
+        self.named_kwargs = get_named_kwargs(fn)
+        self.required_kwargs = get_required_kwargs(fn)
+
+    async def bind(self, request):
+        kwargs = None
+        if self.has_var_kwarg or self.has_named_kwarg or self.required_kwargs:
+            if request.method == 'POST':
+                ct = request.content_type.lower()
+                if ct.startswith('application/json'):
+                    kwargs = await request.json()
+                else:
+                    kwargs = dict(**await request.post())
+            if request.method == 'GET':
+                qs = request.query_string
+                if qs:
+                    kwargs = dict()
+                    for k, v in parse.parse_qs(qs, True).items():
+                        kwargs[k] = v[0]
+        if kwargs is None:
+            kwargs = dict(**request.match_info)
+        else:
+            if not self.has_var_kwarg and self.named_kwargs:
+                copy = dict()
+                for name in self.named_kwargs:
+                    if name in kwargs:
+                        copy[name] = kwargs[name]
+                kwargs = copy
+            for k, v in request.match_info.items():
+                kwargs[k] = v
+        if self.has_request_arg:
+            kwargs['request'] = request
+        if self.required_kwargs:
+            for name in self.required_kwargs:
+                if name not in kwargs:
+                    return None
+        return kwargs
+
+
+def cases(scale):
+    scenarios = [
+        ('get_query', api_blogs, FakeRequest(query_string='page=3&utm_source=feed')),
+        ('get_match_info', get_blog, FakeRequest(match_info=dict(id='0016'))),
+        ('get_var_kwarg', api_search, FakeRequest(query_string='q=python&page=2&sort=new')),
+        ('post_json', api_search, FakeRequest('POST', body=dict(q='python', page='2'),
+                                              content_type='application/json')),
+    ]
+    result = []
+    for name, fn, request in scenarios:
+        legacy = LegacyHandler(fn).bind
+        binder = compile_binder(fn)
+
+        async def run_legacy(bind=legacy, request=request):
+            for _ in range(scale):
+                await bind(request)
+
+        async def run_compiled(bind=binder, request=request):
+            for _ in range(scale):
+                await bind(request)
+
+        result.append(('bind.%s.legacy' % name, run_legacy, scale))
+        result.append(('bind.%s.compiled' % name, run_compiled, scale))
+
+    n_handlers = min(scale, 10000)
+
+    def register_legacy():
+        for _ in range(n_handlers):
+            LegacyHandler(api_search)
+
+    def register_compiled():
+        for _ in range(n_handlers):
+            RequestHandler(None, api_search)
+
+    result.append(('register.legacy', register_legacy, n_handlers))
+    result.append(('register.compiled', register_compiled, n_handlers))
+    return result
+
+
+if __name__ == '__main__':
+    sys.exit(main(cases, description='coroweb argument binding micro benchmarks'))
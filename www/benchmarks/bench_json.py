@@ -0,0 +1,43 @@
+import json
+import sys
+
+import serializers
+from benchmarks import main
+from benchmarks.bench_orm import BenchBlog, make_rows
+from orm import make_record_class
+
+"""
+response_factory 的 JSON 序列化：原来的 json.dumps(default=__dict__).encode() 与 serializers 的编码器对比
+载荷为 dict(page=..., blogs=[...])，与 api 返回的格式一致，规模为博客条数
+用法（在 www 目录下）：
+    python -m benchmarks.bench_json --scales 1000
+"""
+
+
+def legacy_dumps(obj):
+    return json.dumps(obj, ensure_ascii=False, default=lambda o: o.__dict__).encode('utf-8')
+
+
+def cases(scale):
+    rows = make_rows(scale)
+    columns = list(rows[0].keys())
+    record_class = make_record_class('BlogRecord', columns)
+    page = dict(page_index=1, item_count=scale)
+    model_payload = dict(page=page, blogs=[BenchBlog(**r) for r in rows])
+    record_payload = dict(page=page, blogs=[record_class(*r.values()) for r in rows])
+
+    encoders = [('legacy', legacy_dumps), ('json', serializers.JSONEncoder().dumps)]
+    if serializers.orjson is not None:
+        encoders.append(('orjson', serializers.OrjsonEncoder().dumps))
+
+    result = []
+    for name, dumps in encoders:
+        result.append(('json.models.%s' % name, lambda dumps=dumps: dumps(model_payload), scale))
+        # 原来的写法不支持 Record（没有 __dict__）
+        if name != 'legacy':
+            result.append(('json.records.%s' % name, lambda dumps=dumps: dumps(record_payload), scale))
+    return result
+
+
+if __name__ == '__main__':
+    sys.exit(main(cases, description='JSON response serialization micro benchmarks'))
@@ -0,0 +1,106 @@
+import sys
+
+import orm
+from benchmarks import main, run_sync
+from benchmarks.fake_pool import FakeBackend
+from orm import Model, StringField, TextField, FloatField
+
+"""
+orm 热点路径的微基准测试：
+Model 类创建、sql_handle、Model(**row) 构造、save() 中的 getValueOrDefault、__getattr__ 属性访问，
+以及通过假连接池的 findAll/findRecords/save_many
+用法（在 www 目录下）：
+    python -m benchmarks.bench_orm --scales 1000,100000,1000000 --save orm_baseline.json
+    python -m benchmarks.bench_orm --compare orm_baseline.json
+"""
+
+
+class BenchBlog(Model):
+    __table__ = 'bench_blogs'
+
+    id = StringField(primary_key=True, ddl='varchar(50)')
+    user_id = StringField(ddl='varchar(50)')
+    user_name = StringField(ddl='varchar(50)')
+    user_image = StringField(ddl='varchar(500)')
+    name = StringField(ddl='varchar(50)')
+    summary = StringField(ddl='varchar(200)')
+    content = TextField()
+    created_at = FloatField()
+
+
+def make_rows(n):
+    """
+    生成 n 行合成数据，列顺序与 BenchBlog.__select__ 一致
+    """
+    return [dict(id='%050d' % i, user_id='%050d' % (i % 100), user_name='user%d' % (i % 100),
+                 user_image='about:blank', name='blog %d' % i, summary='summary of blog %d' % i,
+                 content='content of blog %d ' % i * 10, created_at=1600000000.0 + i) for i in range(n)]
+
+
+def define_model():
+    class Blog(Model):
+        __table__ = 'blogs'
+
+        id = StringField(primary_key=True, ddl='varchar(50)')
+        user_id = StringField(ddl='varchar(50)', index=True)
+        user_name = StringField(ddl='varchar(50)')
+        user_image = StringField(ddl='varchar(500)')
+        name = StringField(ddl='varchar(50)')
+        summary = StringField(ddl='varchar(200)')
+        content = TextField(deferred=True)
+        created_at = FloatField(index=True)
+
+    return Blog
+
+
+def cases(scale):
+    rows = make_rows(scale)
+    run_sync(orm.create_pool(None, backend=FakeBackend(rows)))
+    models = [BenchBlog(**r) for r in rows]
+    fields = BenchBlog.__fields__
+    kw = dict(orderBy='created_at desc', limit=(0, 10))
+    n_classes = min(scale, 1000)
+
+    def create_classes():
+        for _ in range(n_classes):
+            define_model()
+
+    def sql_handle():
+        for _ in range(scale):
+            BenchBlog.sql_handle(BenchBlog.__select__, kw, 'user_id=?', ['u'])
+
+    def hydrate():
+        [BenchBlog(**r) for r in rows]
+
+    def get_value_or_default():
+        for m in models:
+            list(map(m.getValueOrDefault, fields))
+
+    def getattr_access():
+        for m in models:
+            m.name
+            m.created_at
+
+    async def find_all():
+        await BenchBlog.findAll('user_id=?', ['u'], orderBy='created_at desc')
+
+    async def find_records():
+        await BenchBlog.findRecords('user_id=?', ['u'], orderBy='created_at desc')
+
+    async def save_many():
+        await BenchBlog.save_many(models, batch_size=1000)
+
+    return [
+        ('metaclass.create_class', create_classes, n_classes),
+        ('model.sql_handle', sql_handle, scale),
+        ('model.hydrate', hydrate, scale),
+        ('model.getValueOrDefault', get_value_or_default, scale),
+        ('model.getattr', getattr_access, scale * 2),
+        ('orm.findAll', find_all, scale),
+        ('orm.findRecords', find_records, scale),
+        ('orm.save_many', save_many, scale),
+    ]
+
+
+if __name__ == '__main__':
+    sys.exit(main(cases, description='orm micro benchmarks against an in-memory fake pool'))
@@ -0,0 +1,117 @@
+"""
+内存中的假连接池，实现 orm 后端接口，查询时直接返回预先生成的行，
+用来单独测量 orm 自身的开销，不受网络和数据库影响
+"""
+
+
+class FakeCursor(object):
+
+    def __init__(self, conn, tuples):
+        self._conn = conn
+        self._tuples = tuples
+        self._pos = 0
+        self.rowcount = -1
+
+    def __await__(self):
+        yield from ()
+        return self
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        pass
+
+    def _rows(self):
+        return self._conn.pool.tuple_rows if self._tuples else self._conn.pool.rows
+
+    async def execute(self, sql, args=None):
+        self._pos = 0
+        self.rowcount = len(self._rows())
+        return self.rowcount
+
+    async def executemany(self, sql, args_list):
+        self.rowcount = len(args_list)
+        return self.rowcount
+
+    async def fetchmany(self, size=None):
+        rows = self._rows()[self._pos:self._pos + (size or 1)]
+        self._pos += len(rows)
+        return rows
+
+    async def fetchall(self):
+        rows = self._rows()[self._pos:]
+        self._pos += len(rows)
+        return rows
+
+    async def close(self):
+        pass
+
+
+class FakeConnection(object):
+
+    def __init__(self, pool):
+        self.pool = pool
+
+    def cursor(self, cursorclass='dict'):
+        return FakeCursor(self, cursorclass == 'tuple')
+
+    async def begin(self):
+        pass
+
+    async def commit(self):
+        pass
+
+    async def rollback(self):
+        pass
+
+
+class _Acquire(object):
+
+    def __init__(self, conn):
+        self._conn = conn
+
+    async def __aenter__(self):
+        return self._conn
+
+    async def __aexit__(self, exc_type, exc, tb):
+        pass
+
+
+class FakePool(object):
+
+    def __init__(self, rows):
+        self.rows = rows
+        self.tuple_rows = [tuple(r.values()) for r in rows]
+        self.size = 1
+        self.freesize = 1
+        self.maxsize = 1
+        self._conn = FakeConnection(self)
+
+    def acquire(self):
+        return _Acquire(self._conn)
+
+    def close(self):
+        pass
+
+    async def wait_closed(self):
+        pass
+
+
+class FakeBackend(object):
+    """
+    用法：await orm.create_pool(loop, backend=FakeBackend(rows))
+    :param rows: 查询返回的行（dict），列顺序需与 Model 的 __select__ 一致
+    """
+    name = 'fake'
+    explain = 'explain'
+    IntegrityError = KeyError
+
+    def __init__(self, rows=()):
+        self.rows = list(rows)
+
+    def cursor_class(self, tuples=False, unbuffered=False):
+        return 'tuple' if tuples else 'dict'
+
+    async def create_pool(self, loop, kw):
+        return FakePool(self.rows)
@@ -0,0 +1,165 @@
+import asyncio
+import gzip
+import logging
+import os
+import tempfile
+from collections import OrderedDict
+
+from aiohttp import web
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+"""
+响应压缩：gzip，安装了 brotli 时优先使用 br
+只压缩文本类型且不小于 MIN_SIZE 的完整响应，超过 EXECUTOR_SIZE 的响应体在线程池中压缩，不阻塞事件循环
+由 app.compression_factory 中间件调用；静态文件在构建时预压缩，见 staticfiles.py
+"""
+
+MIN_SIZE = 1024
+EXECUTOR_SIZE = 64 * 1024
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+# 预压缩静态文件时使用最高压缩率，只压缩一次
+STATIC_GZIP_LEVEL = 9
+STATIC_BROTLI_QUALITY = 11
+
+COMPRESSIBLE_TYPES = ('application/json', 'application/javascript', 'application/x-javascript',
+                      'application/xml', 'application/x-ndjson', 'image/svg+xml')
+
+# 带强 ETag 的响应（如 httpcache 缓存的响应）的压缩结果：(ETag, 编码) => 压缩后的 bytes
+MEMO_SIZE = 256
+_memo = OrderedDict()
+
+
+def compressible(content_type):
+    """
+    :param content_type: 不含参数的 Content-Type，如 'text/html'
+    """
+    return content_type.startswith('text/') or content_type in COMPRESSIBLE_TYPES
+
+
+def choose_encoding(accept_encoding):
+    """
+    :param accept_encoding: Accept-Encoding 请求头，如 'gzip, deflate, br;q=0.9'
+    :return: 'br'、'gzip' 或 None
+    """
+    accepted = dict()
+    for item in accept_encoding.lower().split(','):
+        coding, _, params = item.partition(';')
+        q = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        accepted[coding.strip()] = q
+    for coding in ('br', 'gzip') if brotli is not None else ('gzip',):
+        if accepted.get(coding, accepted.get('*', 0.0)) > 0:
+            return coding
+    return None
+
+
+def compress(body, encoding, static=False):
+    """
+    :param static: 是否为预压缩静态文件，使用最高压缩率
+    """
+    if encoding == 'br':
+        return brotli.compress(body, quality=STATIC_BROTLI_QUALITY if static else BROTLI_QUALITY)
+    # mtime=0：相同内容的压缩结果相同
+    return gzip.compress(body, STATIC_GZIP_LEVEL if static else GZIP_LEVEL, mtime=0)
+
+
+async def compress_response(request, resp):
+    """
+    按 Accept-Encoding 压缩响应体，不满足条件的响应原样返回
+    压缩后强 ETag 改为弱 ETag（内容相同、编码不同），If-None-Match 仍然可以命中
+    """
+    if type(resp) is not web.Response or resp.status != 200 or 'Content-Encoding' in resp.headers \
+            or not compressible(resp.content_type):
+        return resp
+    if resp.body is None:
+        return resp
+    if not isinstance(resp.body, bytes):
+        # body=str 时 aiohttp 包装成 StringPayload，这里无法压缩，构造响应时应先 encode('utf-8')
+        logging.warning('response for %s is not compressed: body is %s, not bytes'
+                        % (request.path, type(resp.body).__name__))
+        return resp
+    if len(resp.body) < MIN_SIZE:
+        return resp
+    encoding = choose_encoding(request.headers.get('Accept-Encoding', ''))
+    vary = resp.headers.get('Vary')
+    if vary is None:
+        resp.headers['Vary'] = 'Accept-Encoding'
+    elif 'accept-encoding' not in vary.lower():
+        resp.headers['Vary'] = vary + ', Accept-Encoding'
+    if encoding is None:
+        return resp
+    etag = resp.headers.get('ETag')
+    memo_key = (etag, encoding) if etag and not etag.startswith('W/') else None
+    body = _memo.get(memo_key) if memo_key else None
+    if body is None:
+        if len(resp.body) >= EXECUTOR_SIZE:
+            body = await asyncio.get_event_loop().run_in_executor(None, compress, resp.body, encoding)
+        else:
+            body = compress(resp.body, encoding)
+        if memo_key:
+            _memo[memo_key] = body
+            while len(_memo) > MEMO_SIZE:
+                _memo.popitem(last=False)
+    else:
+        _memo.move_to_end(memo_key)
+    resp.body = body
+    resp.headers['Content-Encoding'] = encoding
+    if etag and not etag.startswith('W/'):
+        resp.headers['ETag'] = 'W/' + etag
+    return resp
+
+
+def precompress_file(path):
+    """
+    为静态文件生成 .gz（以及 .br）文件，已有且不早于原文件时跳过，压缩后没有变小的不保留
+    先写入同目录的临时文件再 os.replace，多个进程同时启动时不会读到或保留写了一半的文件；
+    目录只读等写入失败时只记录日志，不影响启动
+    :return: 生成的文件列表
+    """
+    try:
+        st = os.stat(path)
+    except OSError as e:
+        logging.warning('precompress %s failed: %s' % (path, e))
+        return []
+    if st.st_size < MIN_SIZE:
+        return []
+    written = []
+    data = None
+    for encoding, ext in (('gzip', '.gz'), ('br', '.br')):
+        if encoding == 'br' and brotli is None:
+            continue
+        target = path + ext
+        try:
+            if os.path.exists(target) and os.stat(target).st_mtime >= st.st_mtime:
+                continue
+            if data is None:
+                with open(path, 'rb') as f:
+                    data = f.read()
+            body = compress(data, encoding, static=True)
+            if len(body) >= len(data):
+                continue
+            fd, tmp = tempfile.mkstemp(prefix='.%s.' % os.path.basename(target), dir=os.path.dirname(target))
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    f.write(body)
+                # mkstemp 创建的文件只有属主可读，改为与原文件相同的权限
+                os.chmod(tmp, st.st_mode & 0o777)
+                os.replace(tmp, target)
+            except BaseException:
+                os.remove(tmp)
+                raise
+        except OSError as e:
+            logging.warning('precompress %s failed: %s' % (target, e))
+            continue
+        written.append(target)
+    return written
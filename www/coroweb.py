@@ -1,14 +1,18 @@
 # import asyncio
 import asyncio
 import functools
+import importlib.util
 import inspect
+import json
 import logging
 import os
-from urllib import parse
 
 from aiohttp import web
 
 from apis import APIError
+from httpcache import CachePolicy
+from staticfiles import StaticAssets
+from uploads import BodyReader, Upload, close_uploads, read_multipart
 
 """
 视图函数（URL处理函数）
@@ -49,6 +53,19 @@ def post(path):
     return decorator
 
 
+def cached(ttl=60, vary=()):
+    '''
+        Define decorator @cached(ttl=60, vary=('Cookie',))，与 @get 一起使用，
+        缓存渲染后的GET响应，见 httpcache.py
+    '''
+
+    def decorator(func):
+        func.__cache__ = CachePolicy(ttl, vary)
+        return func
+
+    return decorator
+
+
 # 使用inspect模块，检查视图函数的参数
 
 # inspect.Parameter.kind 类型：
@@ -71,8 +88,8 @@ def get_required_kwargs(fn):
     # 获取函数 fn 的参数，ordered mapping
     params = inspect.signature(fn).parameters
     for name, param in params.items():
-        # * 或者 *args 后面的参数
-        if param.kind == param.KEYWORD_ONLY:
+        # * 或者 *args 后面的参数，且没有默认值
+        if param.kind == param.KEYWORD_ONLY and param.default == param.empty:
             args.append(name)
     return tuple(args)
 
@@ -149,106 +166,179 @@ def has_request_arg(fn):
     return found
 
 
-class RequestHandler(object):
-    """
-    RequestHandler
-    需要处理以下问题：
-    1、确定HTTP请求的方法（’POST’or’GET’）（用request.method获取）
-    2、根据HTTP请求的content_type字段，选用不同解析方法获取参数。（用request.content_type获取）
-    3、将获取的参数经处理，使其完全符合视图函数接收的参数形式
-    4、调用视图函数
-    """
+def _to_bool(value):
+    # 与 int/float 一样，无法识别的值抛出 ValueError，返回400
+    value = value.lower()
+    if value in ('1', 'true', 'yes', 'on'):
+        return True
+    if value in ('0', 'false', 'no', 'off'):
+        return False
+    raise ValueError('Invalid bool value: %s' % value)
 
-    def __init__(self, app, fn):
 
-        self.__app = app
-        self.__func = fn
-        self.__has_request_arg = has_request_arg(fn)  # 判断是否有请求参数
-        self.__has_var_kwarg = has_var_kwarg(fn)  # 判断是否有关键字参数
-        self.__has_named_kwarg = has_named_kwarg(fn)  # 判断是否有命名关键字参数
-        self.__named_kwargs = get_named_kwargs(fn)  # 获取函数命名关键字参数
-        self.__required_kwargs = get_required_kwargs(fn)  # 获取函数命名关键字参数，且非默认参数
-
-    # Make RequestHandler callable
-    # 1.定义kw，用于保存参数
-    # 2.判断视图函数是否存在关键词参数，如果存在根据POST或者GET方法将request请求内容保存到kw
-    # 3.如果kw为空（说明request无请求内容），则将match_info列表里的资源映射给kw；若不为空，把命名关键词参数内容给kw
-    # 4.完善_has_request_arg和_required_kw_args属性
-    async def __call__(self, request):
-        # 1.定义kw，用于保存参数
+# 根据参数注解转换类型，如 def api_blogs(*, page: int = 1)
+CONVERTERS = {int: int, float: float, bool: _to_bool, str: str}
+
+
+def compile_binder(fn):
+    """
+    在注册时分析视图函数的签名，生成参数绑定函数，每个请求只做必要的工作：
+    签名只在注册时分析一次，GET 使用 aiohttp 已解析并缓存的 request.query，
+    没有 **kw 时只取命名关键字参数，有类型注解的参数转换类型
+
+    :param fn: 视图函数
+    :return: 协程函数 bind(request)，返回 kwargs；参数有误时返回 web.HTTPBadRequest
+    """
+    params = inspect.signature(fn).parameters
+    has_request = has_request_arg(fn)
+    var_kwarg = bool(has_var_kwarg(fn))
+    named_kwargs = get_named_kwargs(fn)
+    required_kwargs = get_required_kwargs(fn)
+    converters = tuple((name, CONVERTERS[params[name].annotation]) for name in named_kwargs
+                       if params[name].annotation in CONVERTERS)
+    # 注解为 Upload 的文件参数，注解为 BodyReader 的请求体流参数，见 uploads.py
+    uploads = dict((name, Upload() if params[name].annotation is Upload else params[name].annotation)
+                   for name in named_kwargs
+                   if params[name].annotation is Upload or isinstance(params[name].annotation, Upload))
+    readers = tuple(name for name in named_kwargs if params[name].annotation is BodyReader)
+    needs_params = var_kwarg or bool(named_kwargs)
+
+    async def bind(request):
         kwargs = None
-        # 2.判断视图函数是否存在关键词参数，如果存在根据POST或者GET方法将request请求内容保存到kw
-        if self.__has_var_kwarg or self.__has_named_kwarg or self.__required_kwargs:
+        # 视图函数存在关键词参数时，根据POST或者GET方法将request请求内容保存到kwargs
+        if needs_params:
+            if request.method == 'POST' and readers:
+                # 请求体由视图函数自己读取
+                kwargs = dict((name, BodyReader(request)) for name in readers)
             # 如果是POST，则进行数据类型的判断，并将数据保存到kwargs中
-            if request.method == 'POST':
+            elif request.method == 'POST':
+                ct = request.content_type
                 # 不存在Content-Type，返回报错
-                if not request.content_type:
+                if not ct:
                     return web.HTTPBadRequest(text='Missing Content-Type.')
-                ct = request.content_type.lower()
+                ct = ct.lower()
                 # JSON 数据格式
                 if ct.startswith('application/json'):
                     # Read request body decoded as json
                     params = await request.json()
                     if not isinstance(params, dict):
                         return web.HTTPBadRequest(text='JSON body must be dict object.')
-                    kwargs = params
+                elif uploads and ct.startswith('multipart/form-data'):
+                    # 文件分块写入临时文件，不整个读入内存
+                    params = await read_multipart(request, uploads)
                 # form 表单数据被编码为 key/value 格式发送到服务器（表单默认的提交数据的格式）
                 elif ct.startswith('application/x-www-form-urlencoded') or ct.startswith('multipart/form-data'):
                     # Read POST parameters from request body
                     params = await request.post()
-                    kwargs = dict(**params)
                 else:
                     return web.HTTPBadRequest(text='Unsupported Content-Type: %s' % request.content_type)
+                if var_kwarg:
+                    # request.json() 和 read_multipart() 每次都返回新的dict，可以直接使用；
+                    # request.post() 返回的是只读的 MultiDictProxy，需要复制
+                    kwargs = params if type(params) is dict else dict(params)
+                else:
+                    # Remove all unnamed kwargs
+                    # 只保留命名关键字参数，没有对应参数的上传文件直接删除
+                    kwargs = dict((name, params[name]) for name in named_kwargs if name in params)
+                    if uploads:
+                        close_uploads(dict((k, v) for k, v in params.items() if k not in kwargs))
             # 如果是GET请求，将相关参数放到kwargs
-            if request.method == 'GET':
+            elif request.method == 'GET':
                 # The query string in the URL, e.g., id=10
-                qs = request.query_string
-                if qs:
-                    kwargs = dict()
-                    # {'id': ['10']}
-                    for k, v in parse.parse_qs(qs, True).items():
-                        kwargs[k] = v[0]
-        # 3.如果kw为空（说明request无请求内容），则将match_info列表里的资源映射给kw；若不为空，把命名关键词参数内容给kw
+                # request.query 由 aiohttp 解析一次并缓存，重复的参数取第一个值
+                query = request.query
+                if query:
+                    if var_kwarg:
+                        kwargs = dict()
+                        for k, v in query.items():
+                            kwargs.setdefault(k, v)
+                    else:
+                        kwargs = dict((name, query[name]) for name in named_kwargs if name in query)
+        # kwargs为空（说明request无请求内容），则将match_info列表里的资源映射给kwargs
         if kwargs is None:
-            kwargs = dict(**request.match_info)
+            kwargs = dict(request.match_info)
         else:
-            if not self.__has_var_kwarg and self.__named_kwargs:
-                # Remove all unnamed kwargs
-                copy = dict()
-                for name in self.__named_kwargs:
-                    if name in kwargs:
-                        copy[name] = kwargs[name]
-                kwargs = copy
             # Check named kwargs
             for k, v in request.match_info.items():
                 if k in kwargs:
                     logging.warning('Duplicate arg name in named kwargs and kwargs: %s' % k)
                 kwargs[k] = v
-        # 4.完善_has_request_arg和_required_kwargs属性
-        if self.__has_request_arg:
+        if has_request:
             kwargs['request'] = request
         # Check required kwargs
-        if self.__required_kwargs:
-            for name in self.__required_kwargs:
-                # 若未传入必须参数值，报错。
-                if name not in kwargs:
-                    return web.HTTPBadRequest(text='Missing argument: %s' % name)
-        logging.info('Call with kwargs: %s' % str(kwargs))
+        for name in required_kwargs:
+            # 若未传入必须参数值，报错。
+            if name not in kwargs:
+                if uploads:
+                    close_uploads(kwargs)
+                return web.HTTPBadRequest(text='Missing argument: %s' % name)
+        for name, convert in converters:
+            value = kwargs.get(name)
+            if isinstance(value, str):
+                try:
+                    kwargs[name] = convert(value)
+                except ValueError:
+                    if uploads:
+                        close_uploads(kwargs)
+                    return web.HTTPBadRequest(text='Invalid argument: %s' % name)
+        return kwargs
+
+    bind.has_uploads = bool(uploads)
+    return bind
+
+
+class RequestHandler(object):
+    """
+    RequestHandler
+    需要处理以下问题：
+    1、确定HTTP请求的方法（’POST’or’GET’）（用request.method获取）
+    2、根据HTTP请求的content_type字段，选用不同解析方法获取参数。（用request.content_type获取）
+    3、将获取的参数经处理，使其完全符合视图函数接收的参数形式
+    4、调用视图函数
+    参数的解析在注册时由 compile_binder 编译好，见 compile_binder
+    """
+
+    def __init__(self, app, fn):
+
+        self.__app = app
+        self.__func = fn
+        self.__bind = compile_binder(fn)
+        self.__has_uploads = self.__bind.has_uploads
+        # @cached 声明的缓存策略，由 app.cache_factory 使用
+        self.cache_policy = getattr(fn, '__cache__', None)
+
+    async def __call__(self, request):
+        kwargs = await self.__bind(request)
+        if isinstance(kwargs, web.StreamResponse):
+            return kwargs
+        logging.info('Call with kwargs: %s', kwargs)
         try:
             r = await self.__func(**kwargs)
             return r
         except APIError as e:
             return dict(error=e.error, data=e.data, message=e.message)
+        finally:
+            # 删除视图函数没有 save() 的上传文件
+            if self.__has_uploads:
+                close_uploads(kwargs)
 
 
 # 添加静态文件，如image，css，javascript等
-def add_static(app):
+def add_static(app, path=None, prefix='/static/', precompress=False):
+    """
+    启动时计算静态文件的哈希，带哈希的URL长期缓存，见 staticfiles.py
+    :param precompress: 启动时生成 .gz/.br，默认不生成，由构建步骤 python staticfiles.py 预压缩
+    :return: StaticAssets，其 url() 方法供模板使用
+    """
     # 拼接static文件目录
-    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static')
-    # path = os.path.join(os.path.abspath('.'), 'static')
-
-    app.router.add_static('/static/', path)
-    logging.info('add static %s => %s' % ('/static/', path))
+    if path is None:
+        path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static')
+    assets = StaticAssets(path, prefix)
+    assets.scan(precompress)
+    app.router.add_route('GET', prefix + '{filename:.+}', assets.handle)
+    app['__static__'] = assets
+    logging.info('add static %s => %s' % (prefix, path))
+    return assets
 
 
 # 编写一个add_route函数，用来注册一个视图函数
@@ -274,30 +364,137 @@ def add_route(app, fn):
     logging.info(
         'add route %s %s => %s(%s)' % (method, path, fn.__name__, ','.join(inspect.signature(fn).parameters.keys())))
     # 在app中注册经RequestHandler类封装的视图函数
-    app.router.add_route(method, path, RequestHandler(app, fn))
+    # 注册的是协程方法 __call__：aiohttp 3 会把非协程函数的 handler 再包一层并要求返回 StreamResponse，
+    # 视图函数返回的 dict 等就到不了 response_factory；RequestHandler 实例可通过 handler.__self__ 取得
+    app.router.add_route(method, path, RequestHandler(app, fn).__call__)
 
 
-# 导入模块，批量注册视图函数
-def add_routes(app, module_name):
+def _import_module(module_name):
     n = module_name.rfind('.')  # 从右侧检索，返回索引。若无，返回-1。
     # 导入整个模块
     if n == -1:
         # __import__ 作用同import语句，但__import__是一个函数，并且只接收字符串作为参数
         # __import__('os',globals(),locals(),['path','pip'], 0) ,等价于from os import path, pip
-        mod = __import__(module_name, globals(), locals, [], 0)
-    else:
-        name = module_name[(n + 1):]
-        # 只获取最终导入的模块，为后续调用dir()
-        mod = getattr(__import__(module_name[:n], globals(), locals, [name], 0), name)
+        return __import__(module_name, globals(), locals, [], 0)
+    name = module_name[(n + 1):]
+    # 只获取最终导入的模块，为后续调用dir()
+    return getattr(__import__(module_name[:n], globals(), locals, [name], 0), name)
+
+
+def _scan_routes(mod):
+    """
+    :return: 模块中的视图函数列表 [(属性名, 视图函数)]
+    """
+    routes = []
     for attr in dir(mod):  # dir()迭代出mod模块中所有的类，实例及函数等对象,str形式
         if attr.startswith('_'):
             continue  # 忽略'_'开头的对象，直接继续for循环
         fn = getattr(mod, attr)
-        # 确保是函数
-        if callable(fn):
-            # 确保视图函数存在method和path
-            method = getattr(fn, '__method__', None)
-            path = getattr(fn, '__route__', None)
-            if method and path:
-                # 注册
-                add_route(app, fn)
+        # 确保是函数，且存在method和path
+        if callable(fn) and getattr(fn, '__method__', None) and getattr(fn, '__route__', None):
+            routes.append((attr, fn))
+    return routes
+
+
+def _module_mtime(module_name):
+    """
+    不导入模块本身，取模块文件的修改时间；找不到文件时返回None
+    """
+    try:
+        spec = importlib.util.find_spec(module_name)
+    except (ImportError, ValueError):
+        return None
+    if spec is None or not spec.origin or not os.path.isfile(spec.origin):
+        return None
+    return os.path.getmtime(spec.origin)
+
+
+def build_manifest(*module_names):
+    """
+    导入视图模块，生成路由清单，部署时生成一次，如：python coroweb.py routes.json handlers
+    :param module_names: 视图模块名
+    :return: {模块名: dict(mtime=模块文件修改时间, routes=[[method, path, 属性名]])}
+    """
+    manifest = dict()
+    for module_name in module_names:
+        mod = _import_module(module_name)
+        manifest[module_name] = dict(
+            mtime=_module_mtime(module_name),
+            routes=[[fn.__method__, fn.__route__, attr] for attr, fn in _scan_routes(mod)])
+    return manifest
+
+
+def save_manifest(path, *module_names):
+    with open(path, 'w') as f:
+        json.dump(build_manifest(*module_names), f, indent=2, sort_keys=True)
+
+
+def load_manifest(path, module_name):
+    """
+    :param path: 路由清单文件
+    :param module_name: 视图模块名
+    :return: 该模块的路由列表 [[method, path, 属性名]]；清单不存在、没有该模块或模块文件已修改时返回None
+    """
+    try:
+        with open(path) as f:
+            entry = json.load(f).get(module_name)
+    except (OSError, ValueError):
+        return None
+    if entry is None:
+        return None
+    mtime = _module_mtime(module_name)
+    if mtime is None or mtime != entry['mtime']:
+        logging.info('route manifest %s is stale for %s' % (path, module_name))
+        return None
+    return entry['routes']
+
+
+class LazyRequestHandler(object):
+    """
+    按路由清单注册的视图：第一次请求时才导入视图模块并创建 RequestHandler
+    """
+
+    def __init__(self, app, module_name, attr):
+        self.__app = app
+        self.__module_name = module_name
+        self.__attr = attr
+        self.__handler = None
+
+    @property
+    def cache_policy(self):
+        # 视图模块导入之前不知道缓存策略，第一次请求不缓存
+        return self.__handler.cache_policy if self.__handler is not None else None
+
+    async def __call__(self, request):
+        if self.__handler is None:
+            # 导入是同步的，不会有两个请求同时导入
+            fn = getattr(_import_module(self.__module_name), self.__attr)
+            logging.info('load view %s.%s' % (self.__module_name, self.__attr))
+            self.__handler = RequestHandler(self.__app, fn)
+        return await self.__handler(request)
+
+
+# 导入模块，批量注册视图函数
+def add_routes(app, module_name, manifest=None):
+    """
+    :param app:
+    :param module_name: 视图模块名
+    :param manifest: 路由清单文件（见 build_manifest），清单有效时不导入视图模块，
+                     注册 LazyRequestHandler，第一次请求时再导入；无效时回退到导入模块扫描
+    """
+    routes = load_manifest(manifest, module_name) if manifest else None
+    if routes is not None:
+        for method, path, attr in routes:
+            logging.info('add lazy route %s %s => %s.%s' % (method, path, module_name, attr))
+            app.router.add_route(method, path, LazyRequestHandler(app, module_name, attr).__call__)
+        return
+    for attr, fn in _scan_routes(_import_module(module_name)):
+        # 注册
+        add_route(app, fn)
+
+
+if __name__ == '__main__':
+    import sys
+
+    # 生成路由清单：python coroweb.py routes.json test_view
+    save_manifest(sys.argv[1], *sys.argv[2:])
@@ -0,0 +1,175 @@
+import asyncio
+import hashlib
+import time
+from collections import OrderedDict
+
+from aiohttp import web
+
+"""
+GET 响应缓存：缓存渲染后的响应体，带强 ETag，If-None-Match 命中时返回304
+视图函数用 @cached(ttl=..., vary=...) 声明（见 coroweb.cached），由 app.cache_factory 中间件处理
+"""
+
+# 请求头含这些字段时响应因用户而异，只允许浏览器缓存
+_PRIVATE_HEADERS = ('cookie', 'authorization')
+
+
+class CachePolicy(object):
+    """
+    视图函数的缓存策略
+    """
+
+    def __init__(self, ttl=60, vary=()):
+        """
+        :param ttl: 过期时间（秒）
+        :param vary: 影响响应内容的请求头，如 ('Cookie', 'Accept-Language')
+        """
+        self.ttl = ttl
+        self.vary = tuple(vary)
+        private = any(h.lower() in _PRIVATE_HEADERS for h in self.vary)
+        self.cache_control = '%s, max-age=%d' % ('private' if private else 'public', ttl)
+
+    def key(self, request):
+        """
+        缓存key：路径和查询字符串，加上 vary 中的请求头
+        """
+        return (request.path_qs,) + tuple(request.headers.get(h, '') for h in self.vary)
+
+
+class CachedResponse(object):
+    """
+    缓存的响应，可以多次生成 web.Response
+    """
+    __slots__ = ('body', 'etag', 'headers', 'validators')
+
+    def __init__(self, resp, policy):
+        self.body = resp.body
+        self.etag = '"%s"' % hashlib.blake2b(self.body, digest_size=16).hexdigest()
+        # 304 只带校验和缓存相关的头
+        self.validators = {'ETag': self.etag, 'Cache-Control': policy.cache_control}
+        if policy.vary:
+            self.validators['Vary'] = ', '.join(policy.vary)
+        self.headers = dict(self.validators)
+        self.headers['Content-Type'] = resp.headers.get('Content-Type', 'application/octet-stream')
+
+    def matches(self, request):
+        """
+        If-None-Match 是否包含当前的 ETag（304 使用弱比较，忽略 W/ 前缀）
+        """
+        header = request.headers.get('If-None-Match')
+        if not header:
+            return False
+        for tag in header.split(','):
+            tag = tag.strip()
+            if tag == '*' or tag == self.etag or tag[2:] == self.etag and tag.startswith('W/'):
+                return True
+        return False
+
+    def response(self, request):
+        if self.matches(request):
+            return web.Response(status=304, headers=self.validators)
+        return web.Response(body=self.body, headers=self.headers)
+
+
+def cacheable(resp):
+    """
+    只缓存已完整生成的 200 响应，流式响应和已设置 Cookie 的响应不缓存
+    """
+    return type(resp) is web.Response and resp.status == 200 and isinstance(resp.body, bytes) \
+        and 'Set-Cookie' not in resp.headers
+
+
+class ResponseCache(object):
+    """
+    响应缓存，LRU淘汰，条目数和总字节数都有上限
+    同一个key同时只有一个请求执行视图函数，其他请求等待它的结果
+    """
+
+    def __init__(self, size=1024, max_bytes=64 * 1024 * 1024):
+        """
+        :param size: 最多缓存的条目数
+        :param max_bytes: 缓存的响应体总字节数上限
+        """
+        self.size = size
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self._data = OrderedDict()  # key => (过期时间, CachedResponse)
+        self._inflight = dict()  # key => 正在渲染的请求的 future
+
+    def get(self, key):
+        item = self._data.get(key)
+        if item is not None:
+            expires, entry = item
+            if expires > time.monotonic():
+                self._data.move_to_end(key)
+                self.hits += 1
+                return entry
+            self._remove(key)
+        return None
+
+    def put(self, key, entry, ttl):
+        if len(entry.body) > self.max_bytes:
+            return
+        self._remove(key)
+        self._data[key] = (time.monotonic() + ttl, entry)
+        self.bytes += len(entry.body)
+        while len(self._data) > self.size or self.bytes > self.max_bytes:
+            _, (_, old) = self._data.popitem(last=False)
+            self.bytes -= len(old.body)
+
+    def _remove(self, key):
+        item = self._data.pop(key, None)
+        if item is not None:
+            self.bytes -= len(item[1].body)
+
+    async def fetch(self, request, handler, policy):
+        """
+        :param request: 请求
+        :param handler: 生成响应的协程函数
+        :param policy: CachePolicy
+        :return: web.Response
+        """
+        key = policy.key(request)
+        entry = self.get(key)
+        if entry is not None:
+            return entry.response(request)
+        future = self._inflight.get(key)
+        if future is not None:
+            self.coalesced += 1
+            # shield：等待方被取消时不影响正在渲染的请求
+            entry = await asyncio.shield(future)
+            if entry is not None:
+                return entry.response(request)
+            # 结果不可缓存或渲染失败，自己执行视图函数
+            return await handler(request)
+        self.misses += 1
+        future = self._inflight[key] = asyncio.get_event_loop().create_future()
+        entry = None
+        try:
+            resp = await handler(request)
+            if cacheable(resp):
+                entry = CachedResponse(resp, policy)
+                self.put(key, entry, policy.ttl)
+        finally:
+            del self._inflight[key]
+            future.set_result(entry)
+        if entry is None:
+            return resp
+        return entry.response(request)
+
+    def invalidate(self, prefix=''):
+        """
+        删除路径以 prefix 开头的条目，默认全部删除
+        """
+        for key in [k for k in self._data if k[0].startswith(prefix)]:
+            self._remove(key)
+
+    def stats(self):
+        return dict(size=len(self._data), bytes=self.bytes, hits=self.hits, misses=self.misses,
+                    coalesced=self.coalesced)
+
+
+response_cache = ResponseCache()
@@ -0,0 +1,132 @@
+import logging
+import os
+import random
+import threading
+import time
+
+"""
+按时间递增的紧凑ID（snowflake 结构）：
+41位毫秒时间戳 | 10位机器号 | 12位序号，共63位
+转换为13个字符的 Crockford base32 字符串，字符串顺序与生成顺序一致，
+作为 InnoDB 主键时新行总是追加在索引末尾，不会造成随机的页分裂
+"""
+
+# 2020-01-01 00:00:00 UTC，41位毫秒时间戳可以用到2089年
+EPOCH_MS = 1577836800000
+
+WORKER_BITS = 10
+SEQUENCE_BITS = 12
+MAX_WORKER = (1 << WORKER_BITS) - 1
+MAX_SEQUENCE = (1 << SEQUENCE_BITS) - 1
+
+_ALPHABET = '0123456789abcdefghjkmnpqrstvwxyz'
+ID_LENGTH = 13
+
+
+def encode(n):
+    """
+    把整数ID编码为定长的 base32 字符串
+    """
+    chars = []
+    for _ in range(ID_LENGTH):
+        chars.append(_ALPHABET[n & 31])
+        n >>= 5
+    return ''.join(reversed(chars))
+
+
+def decode(s):
+    """
+    encode 的逆运算
+    """
+    n = 0
+    for c in s:
+        n = (n << 5) | _ALPHABET.index(c)
+    return n
+
+
+def _random_worker_id(exclude=None):
+    worker_id = exclude
+    while worker_id == exclude:
+        worker_id = random.SystemRandom().randint(0, MAX_WORKER)
+    logging.warning('using random worker id %s (pid %s), set a distinct WORKER_ID for each process'
+                    % (worker_id, os.getpid()))
+    return worker_id
+
+
+def _default_worker_id():
+    """
+    优先取环境变量 WORKER_ID；没有时随机选取并输出日志。
+    不用进程号：容器里的进程号通常都是1，相差1024的进程号也会得到相同的机器号；
+    随机选取仍可能重复，多进程部署时应为每个进程设置不同的 WORKER_ID
+    """
+    value = os.environ.get('WORKER_ID')
+    if value is not None:
+        return int(value)
+    return _random_worker_id()
+
+
+class IdGenerator(object):
+
+    def __init__(self, worker_id=None, epoch=EPOCH_MS):
+        """
+        :param worker_id: 机器号，0~1023，多进程/多机部署时需要互不相同，
+                          默认取环境变量 WORKER_ID，没有时见 _default_worker_id
+        :param epoch: 时间戳起点（毫秒）
+        """
+        if worker_id is None:
+            worker_id = _default_worker_id()
+        if not 0 <= worker_id <= MAX_WORKER:
+            raise ValueError('worker id must be between 0 and %d: %s' % (MAX_WORKER, worker_id))
+        self.worker_id = worker_id
+        self.epoch = epoch
+        self._last = -1
+        self._sequence = 0
+        self._lock = threading.Lock()
+
+    def next_int(self):
+        """
+        :return: 单调递增的整数ID
+        """
+        with self._lock:
+            now = int(time.time() * 1000) - self.epoch
+            if now > self._last:
+                self._last = now
+                self._sequence = 0
+            else:
+                # 同一毫秒内或时钟回拨：沿用上次的时间戳，序号用完时借用下一毫秒，保证不重复且递增
+                self._sequence += 1
+                if self._sequence > MAX_SEQUENCE:
+                    self._last += 1
+                    self._sequence = 0
+            return (self._last << (WORKER_BITS + SEQUENCE_BITS)) | (self.worker_id << SEQUENCE_BITS) | self._sequence
+
+    def next_id(self):
+        """
+        :return: 13个字符的ID字符串
+        """
+        return encode(self.next_int())
+
+
+_generator = IdGenerator()
+
+
+def _reset_after_fork():
+    # fork 出的子进程与父进程的 WORKER_ID 相同，重新随机选取与父进程不同的机器号，避免生成相同的ID
+    global _generator
+    _generator = IdGenerator(_random_worker_id(exclude=_generator.worker_id))
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def next_id():
+    return _generator.next_id()
+
+
+def id_time(s):
+    """
+    :param s: next_id 生成的ID
+    :return: 生成时间（秒）
+    """
+    return ((decode(s) >> (WORKER_BITS + SEQUENCE_BITS)) + EPOCH_MS) / 1000.0
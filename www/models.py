@@ -1,44 +1,46 @@
-import time, uuid
+import time
 
+from ids import next_id
 from orm import Model, StringField, BooleanField, FloatField, TextField
 
 
-def next_id():
-    return "%015d%s000" % (int(time.time() * 1000), uuid.uuid4().hex)
-
-
 class User(Model):
     __table__ = "users"
 
-    id = StringField(primary_key=True, default=next_id(), ddl='varchar(50)')
-    email = StringField(ddl='varchar(50)')
+    id = StringField(primary_key=True, default=next_id, ddl='varchar(50)')
+    email = StringField(ddl='varchar(50)', unique=True)
     passwd = StringField(ddl='varchar(50)')
     admin = BooleanField()
     name = StringField(ddl='varchar(50)')
     image = StringField(ddl='varchar(500)')
-    created_at = FloatField(default=time.time())
+    created_at = FloatField(default=time.time, index=True)
 
 
 class Blog(Model):
     __table__ = "blogs"
+    # 分页每次都要统计总数，短时间缓存即可
+    __count_ttl__ = 5
 
-    id = StringField(primary_key=True, default=next_id(), ddl='varchar(50)')
-    user_id = StringField(ddl='varchar(50)')
+    id = StringField(primary_key=True, default=next_id, ddl='varchar(50)')
+    user_id = StringField(ddl='varchar(50)', index=True)
     user_name = StringField(ddl='varchar(50)')
     user_image = StringField(ddl='varchar(500)')
     name = StringField(ddl='varchar(50)')
     summary = StringField(ddl='varchar(200)')
-    content = TextField()
-    created_at = FloatField(default=time.time())
+    # 列表页只显示摘要，正文在需要时再加载
+    content = TextField(deferred=True)
+    created_at = FloatField(default=time.time, index=True)
 
 
 class Comment(Model):
     __table__ = "comments"
+    # 按博客取评论并按时间排序
+    __indexes__ = (('blog_id', 'created_at'),)
 
-    id = StringField(primary_key=True, default=next_id(), ddl='varchar(50)')
+    id = StringField(primary_key=True, default=next_id, ddl='varchar(50)')
     blog_id = StringField(ddl='varchar(50)')
     user_id = StringField(ddl='varchar(50)')
     user_name = StringField(ddl='varchar(50)')
     user_image = StringField(ddl='varchar(500)')
     content = TextField()
-    created_at = FloatField(default=time.time())
+    created_at = FloatField(default=time.time)
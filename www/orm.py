@@ -1,68 +1,356 @@
-import aiomysql, asyncio
+import asyncio, base64, contextvars, itertools, json, keyword, time
+from collections import OrderedDict
+from contextlib import asynccontextmanager, contextmanager
 from logging import info, debug, warning
 
-import pymysql.err
+try:
+    import aiomysql
+    import pymysql.err
+except ImportError:
+    # 只使用 SQLite 后端时可以不安装 aiomysql
+    aiomysql = None
+
+from querylog import query_stats, slow_log
 
 global __pool
+# 当前使用的数据库后端，由 create_pool 设置
+_backend = None
+
+# 只读从库连接池，select 在这些连接池间分流；为空时读写都走主库
+__replicas = []
+__replica_strategy = 'round_robin'
+__replica_counter = itertools.count()
+__read_your_writes = True
+# 当前任务（请求）是否固定从主库读，execute 写入后会置为 True
+_read_primary = contextvars.ContextVar('read_primary', default=False)
+# 当前任务固定使用的连接，由 connection()/transaction() 设置
+_connection = contextvars.ContextVar('connection', default=None)
+_in_transaction = contextvars.ContextVar('in_transaction', default=False)
+# 事务中写操作要作废的缓存，[(Model类, 主键列表)]，提交后才执行，回滚时丢弃
+_pending_invalidations = contextvars.ContextVar('pending_invalidations', default=None)
+# 当前请求的 DataLoader，Model类 => DataLoader，由 loader_scope() 设置
+_loaders = contextvars.ContextVar('loaders', default=None)
+
+# 占位符转换缓存：'?' 格式SQL => aiomysql 的 '%s' 格式SQL
+_statements = dict()
+# 缓存上限，防止把参数直接拼进SQL的调用方撑爆缓存
+STATEMENT_CACHE_SIZE = 1024
 
 
 def log(sql, args=()):
     info('SQL: %s' % sql)
 
 
+def compile_sql(sql):
+    """
+    把 '?' 占位符转换为 '%s'，结果缓存，同一条语句只转换一次
+    :param sql: sql语句
+    :return: 转换后的sql语句
+    """
+    stmt = _statements.get(sql)
+    if stmt is None:
+        stmt = sql.replace('?', '%s')
+        if len(_statements) < STATEMENT_CACHE_SIZE:
+            _statements[sql] = stmt
+    return stmt
+
+
+class MySQLBackend(object):
+    """
+    数据库后端：负责创建连接池，并提供游标类型和主键冲突的异常类型
+    连接池需要提供 acquire()/size/freesize，连接需要提供 cursor()/begin()/commit()/rollback()，
+    游标的接口与 aiomysql 相同，SQL 使用 '%s' 占位符。其他后端见 sqlite_backend.SQLiteBackend
+    """
+    name = 'mysql'
+    explain = 'explain'
+
+    def __init__(self):
+        if aiomysql is None:
+            raise RuntimeError('aiomysql is required for the mysql backend')
+        self.IntegrityError = pymysql.err.IntegrityError
+
+    def cursor_class(self, tuples=False, unbuffered=False):
+        """
+        :param tuples: 每行返回tuple，否则返回dict
+        :param unbuffered: 使用服务端游标，不在客户端缓存结果集
+        """
+        if unbuffered:
+            return aiomysql.SSCursor if tuples else aiomysql.SSDictCursor
+        return aiomysql.Cursor if tuples else aiomysql.DictCursor
+
+    async def create_pool(self, loop, kw):
+        return await aiomysql.create_pool(
+            host=kw.get('host', 'localhost'),
+            port=kw.get('port', 3306),
+            user=kw['user'],
+            password=kw['password'],
+            db=kw['db'],
+            charset=kw.get('charset', 'utf8'),
+            autocommit=kw.get('autocommit', True),
+            maxsize=kw.get('maxsize', 10),
+            minsize=kw.get('minsize', 1),
+            loop=loop
+        )
+
+
+def load_backend(name):
+    """
+    :param name: 'mysql' 或 'sqlite'，也可以直接传入后端实例（如测试用的假连接池）
+    :return: 后端实例
+    """
+    if not isinstance(name, str):
+        return name
+    if name == 'mysql':
+        return MySQLBackend()
+    if name == 'sqlite':
+        from sqlite_backend import SQLiteBackend
+        return SQLiteBackend()
+    raise ValueError('Invalid backend value: %s' % str(name))
+
+
 async def create_pool(loop, **kw):
     """
     创建数据库连接池
     :param loop:
     :param kw:键值对参数
+        backend: 'mysql'（默认）或 'sqlite'，使用 sqlite 时 db 为数据库文件路径
+        replicas: 从库配置列表，每项为dict，未给出的键沿用主库配置
+        replica_strategy: 'round_robin' 轮询，或 'least_busy' 选占用连接最少的从库
+        read_your_writes: 为True时，任务中执行过写操作后，该任务后续的查询都走主库
+        slow_query_threshold: 慢查询阈值（秒），超过的语句写入 orm.slow 日志，None 表示关闭
+        explain_sample_rate: 对慢 SELECT 抽样执行 EXPLAIN 的比例，0~1
+        write_behind_interval: Model.incr 计数的刷新间隔（秒）
+        write_behind_max_rows: 缓冲的行数达到该值时立即刷新
     :return:
     """
     info('create database connection pool...')
-    global __pool
+    global __pool, __replicas, __replica_strategy, __read_your_writes, _backend
+    strategy = kw.get('replica_strategy', 'round_robin')
+    if strategy not in ('round_robin', 'least_busy'):
+        raise ValueError('Invalid replica_strategy value: %s' % str(strategy))
+    backend = load_backend(kw.get('backend', 'mysql'))
     # 携程创建数据库，并设为全局变量
-    __pool = await aiomysql.create_pool(
-        host=kw.get('host', 'localhost'),
-        port=kw.get('port', 3306),
-        user=kw['user'],
-        password=kw['password'],
-        db=kw['db'],
-        charset=kw.get('charset', 'utf8'),
-        autocommit=kw.get('autocommit', True),
-        maxsize=kw.get('maxsize', 10),
-        minsize=kw.get('minsize', 1),
-        loop=loop
-    )
-
-
-async def select(sql, args, size=None):
+    __pool = await backend.create_pool(loop, kw)
+    replicas = []
+    for replica in kw.get('replicas', None) or []:
+        info('create replica connection pool: %s' % replica.get('host', 'localhost'))
+        config = dict(kw)
+        config.update(replica)
+        replicas.append(await backend.create_pool(loop, config))
+    _backend = backend
+    __replicas = replicas
+    __replica_strategy = strategy
+    __read_your_writes = kw.get('read_your_writes', True)
+    query_stats.slow_threshold = kw.get('slow_query_threshold', query_stats.slow_threshold)
+    query_stats.explain_rate = kw.get('explain_sample_rate', query_stats.explain_rate)
+    write_behind.interval = kw.get('write_behind_interval', write_behind.interval)
+    write_behind.max_rows = kw.get('write_behind_max_rows', write_behind.max_rows)
+
+
+async def close_pool():
+    """
+    关闭前刷新 write-behind 缓冲中的计数，然后关闭所有连接池
+    """
+    await write_behind.close()
+    if _backend is None:
+        return
+    for pool in [__pool] + __replicas:
+        pool.close()
+        await pool.wait_closed()
+
+
+def _read_pool():
+    """
+    为查询选择连接池
+    :return: 从库连接池，没有从库或当前任务需要读主库时返回主库连接池
+    """
+    if not __replicas or _read_primary.get():
+        return __pool
+    if __replica_strategy == 'least_busy':
+        return min(__replicas, key=lambda p: p.size - p.freesize)
+    return __replicas[next(__replica_counter) % len(__replicas)]
+
+
+@contextmanager
+def read_primary():
+    """
+    在 with 块中的查询固定走主库，用于刚写入后需要立即读到结果的场景
+    用法：with read_primary(): user = await User.find(uid)
+    """
+    token = _read_primary.set(True)
+    try:
+        yield
+    finally:
+        _read_primary.reset(token)
+
+
+class _PinnedConnection(object):
+    """
+    已固定在当前任务上的连接，退出时不归还连接池
+    """
+
+    def __init__(self, conn):
+        self._conn = conn
+
+    async def __aenter__(self):
+        return self._conn
+
+    async def __aexit__(self, exc_type, exc, tb):
+        pass
+
+
+def _acquire(pool):
+    """
+    获取连接：当前任务已固定连接时复用它，否则从连接池中取
+    :param pool: 连接池
+    """
+    conn = _connection.get()
+    if conn is not None:
+        return _PinnedConnection(conn)
+    return pool.acquire()
+
+
+@asynccontextmanager
+async def connection():
+    """
+    把一个主库连接固定到当前任务，块内的 select/execute 和 Model 方法都复用这一个连接
+    用法：async with connection(): ...
+    注意：块内用 create_task 创建的任务会继承这个连接，不要让它们并发执行SQL
+    """
+    conn = _connection.get()
+    if conn is not None:
+        yield conn
+        return
+    async with __pool.acquire() as conn:
+        token = _connection.set(conn)
+        try:
+            yield conn
+        finally:
+            _connection.reset(token)
+
+
+@asynccontextmanager
+async def transaction():
+    """
+    在固定的连接上开启事务，块正常结束时提交一次，抛出异常时回滚
+    嵌套使用时内层并入外层事务
+    用法：
+        async with transaction():
+            await comment.save()
+            await execute('update blogs set comments = comments + 1 where id=?', [blog_id])
+    """
+    async with connection() as conn:
+        if _in_transaction.get():
+            yield conn
+            return
+        await conn.begin()
+        token = _in_transaction.set(True)
+        pending = []
+        pending_token = _pending_invalidations.set(pending)
+        try:
+            yield conn
+        except BaseException:
+            await conn.rollback()
+            raise
+        else:
+            await conn.commit()
+        finally:
+            _in_transaction.reset(token)
+            _pending_invalidations.reset(pending_token)
+        # 提交之前作废缓存的话，其他协程可能在提交前读到旧数据并重新放入缓存
+        for model, pks in pending:
+            model._invalidate(pks)
+
+
+def _record(sql, args, start, acquired, rows, end=None):
+    """
+    记录一次执行的耗时统计，慢 SELECT 按比例抽样执行 EXPLAIN
+    :param start: 开始获取连接的时间
+    :param acquired: 获取到连接的时间
+    :param end: 执行完成的时间，默认为当前时间
+    """
+    elapsed = (end or time.perf_counter()) - acquired
+    if query_stats.record(sql, elapsed, acquired - start, rows) and query_stats.should_explain(sql):
+        asyncio.ensure_future(_explain(sql, args))
+
+
+async def _explain(sql, args):
+    """
+    对慢查询执行 EXPLAIN 并写入慢查询日志，使用单独的连接，不影响当前任务固定的连接
+    """
+    try:
+        async with _read_pool().acquire() as conn:
+            async with conn.cursor(_backend.cursor_class()) as cur:
+                await cur.execute('%s %s' % (_backend.explain, compile_sql(sql)), args or ())
+                plan = await cur.fetchall()
+        slow_log.warning('explain %s: %s' % (sql, plan))
+    except Exception as e:
+        warning('failed to explain %s: %s' % (sql, e))
+
+
+async def select(sql, args, size=None, tuples=False):
     """
     查询数据库函数
 
     :param sql #sql语句
     :param args #参数
     :param size #查询数据条数
+    :param tuples #为True时每行返回tuple，默认返回dict
 
     :return rs #返回查询到记录
     """
     log(sql, args)
-    global __pool
-    async with __pool.acquire() as conn:
-        async with conn.cursor(aiomysql.DictCursor) as cur:
+    start = time.perf_counter()
+    async with _acquire(_read_pool()) as conn:
+        acquired = time.perf_counter()
+        async with conn.cursor(_backend.cursor_class(tuples)) as cur:
             # cur = await conn.cursor(aiomysql.DictCursor)  # 设置游标
-            await cur.execute(sql.replace('?', '%s'), args or ())  # 执行sql语句
+            await cur.execute(compile_sql(sql), args or ())  # 执行sql语句
             if size:
                 rs = await cur.fetchmany(size)  # 查询指定条数数据
                 if isinstance(rs, asyncio.Future):
                     rs = rs.result()
 
             else:
-                rs = cur.fetchall()  # 查询所有数据
-                if isinstance(rs, asyncio.Future):
-                    rs = rs.result()
+                rs = await cur.fetchall()  # 查询所有数据
 
             await cur.close()  # 关闭游标
-            info(f'rows returned:{len(rs)}')
-            return rs
+    info(f'rows returned:{len(rs)}')
+    _record(sql, args, start, acquired, len(rs))
+    return rs
+
+
+async def select_iter(sql, args, chunk_size=1000):
+    """
+    流式查询，使用服务端游标逐批读取，内存占用只与 chunk_size 有关
+
+    :param sql #sql语句
+    :param args #参数
+    :param chunk_size #每次从服务端读取的条数
+
+    :return 异步生成器，每次产出一批记录（list）
+    """
+    log(sql, args)
+    start = time.perf_counter()
+    async with _acquire(_read_pool()) as conn:
+        acquired = time.perf_counter()
+        # 耗时记到取得第一批为止，之后的时间主要花在调用方处理上；行数在读完或生成器关闭时记录
+        first, rows = None, 0
+        try:
+            # 服务端游标不缓存结果集，关闭时会读完剩余的行，连接才能放回连接池
+            async with conn.cursor(_backend.cursor_class(unbuffered=True)) as cur:
+                await cur.execute(compile_sql(sql), args or ())
+                while True:
+                    rs = await cur.fetchmany(chunk_size)
+                    if first is None:
+                        first = time.perf_counter()
+                    if not rs:
+                        break
+                    rows += len(rs)
+                    yield rs
+        finally:
+            if first is not None:
+                _record(sql, args, start, acquired, rows, first)
 
 
 async def execute(sql, args):
@@ -76,15 +364,55 @@ async def execute(sql, args):
     :return rs #一个整数表示影响的行数
     """
     log(sql)
-    async with __pool.acquire() as conn:
+    start = time.perf_counter()
+    async with _acquire(__pool) as conn:
+        acquired = time.perf_counter()
         try:
             cur = await conn.cursor()
-            await cur.execute(sql.replace('?', '%s'), args)
+            await cur.execute(compile_sql(sql), args)
             affected = cur.rowcount
             await cur.close()
         except BaseException as e:
             raise
-        return affected
+    _record(sql, args, start, acquired, affected)
+    if __read_your_writes:
+        _read_primary.set(True)
+    return affected
+
+
+async def execute_many(sql, args_list, batch_size=500):
+    """
+    批量执行INSERT语句，所有批次共用同一个连接
+
+    aiomysql 的 executemany 会把 insert ... values (...) 改写为多行 insert，
+    每个批次只需一次网络往返。
+
+    :param sql #sql语句
+    :param args_list #参数列表，每个元素对应一行
+    :param batch_size #每批次的行数
+
+    :return counts #列表，每个批次影响的行数
+    """
+    log(sql)
+    if batch_size < 1:
+        raise ValueError('Invalid batch_size value: %s' % str(batch_size))
+    counts = []
+    if not args_list:
+        return counts
+    start = time.perf_counter()
+    async with _acquire(__pool) as conn:
+        acquired = time.perf_counter()
+        cur = await conn.cursor()
+        try:
+            for i in range(0, len(args_list), batch_size):
+                await cur.executemany(compile_sql(sql), args_list[i:i + batch_size])
+                counts.append(cur.rowcount)
+        finally:
+            await cur.close()
+    _record(sql, None, start, acquired, sum(counts))
+    if __read_your_writes:
+        _read_primary.set(True)
+    return counts
 
 
 def create_args_string(num):
@@ -94,6 +422,399 @@ def create_args_string(num):
     return ', '.join(L)  # etc： num =3 ,return = '?, ?, ?'
 
 
+class LRUCache(object):
+    """
+    进程内LRU缓存，带容量上限和过期时间，并统计命中次数
+    """
+
+    def __init__(self, size, ttl=60):
+        """
+        :param size: 最多缓存的条数
+        :param ttl: 过期时间（秒），None 表示不过期
+        """
+        self.size = size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data = OrderedDict()  # key => (过期时间, value)
+
+    def get(self, key, default=None):
+        item = self._data.get(key)
+        if item is not None:
+            expires, value = item
+            if expires is None or expires > time.monotonic():
+                self._data.move_to_end(key)
+                self.hits += 1
+                return value
+            del self._data[key]
+        self.misses += 1
+        return default
+
+    def put(self, key, value):
+        expires = time.monotonic() + self.ttl if self.ttl is not None else None
+        self._data[key] = (expires, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.size:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, key):
+        self._data.pop(key, None)
+
+    def clear(self):
+        self._data.clear()
+
+    def stats(self):
+        return dict(size=len(self._data), hits=self.hits, misses=self.misses, evictions=self.evictions)
+
+    def __len__(self):
+        return len(self._data)
+
+
+def encode_cursor(*values):
+    """
+    把分页起点编码为不透明的游标字符串
+    """
+    return base64.urlsafe_b64encode(json.dumps(values).encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor):
+    """
+    解码 encode_cursor 生成的游标
+    :return: 分页起点的值列表
+    """
+    try:
+        return json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8'))
+    except (ValueError, TypeError, UnicodeError):
+        raise ValueError('Invalid page cursor: %s' % str(cursor))
+
+
+class Record(object):
+    """
+    紧凑记录类的基类
+    子类用 __slots__ 按列保存数据，没有实例 __dict__，比 Model(dict) 省内存，
+    同时提供 keys()/items()/get()/[] 等只读的dict接口，dict(record) 即可转换
+    """
+    __slots__ = ()
+    __columns__ = ()
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key)
+
+    def __iter__(self):
+        return iter(self.__columns__)
+
+    def __len__(self):
+        return len(self.__columns__)
+
+    def __contains__(self, key):
+        return key in self.__columns__
+
+    def keys(self):
+        return self.__columns__
+
+    def values(self):
+        return [getattr(self, c) for c in self.__columns__]
+
+    def items(self):
+        return [(c, getattr(self, c)) for c in self.__columns__]
+
+    def get(self, key, default=None):
+        return getattr(self, key, default) if key in self.__columns__ else default
+
+    def to_dict(self):
+        return dict(self.items())
+
+    def __eq__(self, other):
+        if isinstance(other, Record):
+            return self.to_dict() == other.to_dict()
+        return self.to_dict() == other
+
+    def __repr__(self):
+        return '%s(%s)' % (self.__class__.__name__, ', '.join('%s=%r' % kv for kv in self.items()))
+
+
+def make_record_class(name, columns):
+    """
+    生成紧凑记录类，可直接由游标返回的元组构造：Record(*row)
+    __init__ 和 to_dict 按列名生成，不需要循环和setattr/getattr，to_dict 供 JSON 序列化使用
+    :param name: 类名
+    :param columns: 列名，顺序与查询结果的列顺序一致
+    :return: Record的子类
+    """
+    for c in columns:
+        if not c.isidentifier() or keyword.iskeyword(c):
+            raise ValueError('Invalid column name for record: %s' % c)
+    namespace = dict()
+    exec('def __init__(self, %s):\n%s' % (
+        ', '.join(columns), '\n'.join('    self.%s = %s' % (c, c) for c in columns)), namespace)
+    exec('def to_dict(self):\n    return {%s}' % ', '.join("'%s': self.%s" % (c, c) for c in columns), namespace)
+    return type(name, (Record,), dict(__slots__=tuple(columns), __columns__=tuple(columns),
+                                      __init__=namespace['__init__'], to_dict=namespace['to_dict']))
+
+
+# ResultCache 中执行查询的协程被取消时，等待方收到的结果
+_MISSING = object()
+
+
+class ResultCache(object):
+    """
+    查询结果缓存，按 (sql, 参数) 缓存，LRU淘汰
+    每个条目带有标签（Model类），标签失效时版本号加一，缓存时记录的版本号不一致的条目即作废；
+    同一个key同时只有一个协程执行查询，其他协程等待它的结果，过期时不会一起涌向数据库
+    """
+
+    def __init__(self, size=1024):
+        """
+        :param size: 最多缓存的条目数
+        """
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self._data = OrderedDict()  # key => (过期时间, 标签版本号, value)
+        self._versions = dict()  # 标签 => 版本号
+        self._inflight = dict()  # key => 正在执行的查询的 future
+
+    def _snapshot(self, tags):
+        return tuple(self._versions.get(t, 0) for t in tags)
+
+    async def get_or_compute(self, key, tags, ttl, compute):
+        """
+        :param key: 缓存key
+        :param tags: 标签元组，任一标签失效时条目作废
+        :param ttl: 过期时间（秒）
+        :param compute: 协程函数，未命中时调用
+        :return: 缓存或计算得到的值
+        """
+        item = self._data.get(key)
+        if item is not None:
+            expires, versions, value = item
+            if expires > time.monotonic() and versions == self._snapshot(tags):
+                self._data.move_to_end(key)
+                self.hits += 1
+                return value
+            del self._data[key]
+        future = self._inflight.get(key)
+        if future is not None:
+            self.coalesced += 1
+            # shield：等待方被取消时不影响正在执行的查询
+            value = await asyncio.shield(future)
+            if value is not _MISSING:
+                return value
+            # 执行查询的协程被取消了，取消不应传给其他请求，重新查询（其中一个等待方执行，其余继续等待）
+            return await self.get_or_compute(key, tags, ttl, compute)
+        self.misses += 1
+        future = self._inflight[key] = asyncio.get_event_loop().create_future()
+        # 在查询前记录版本号，查询期间发生的写操作会让这次的结果直接作废
+        versions = self._snapshot(tags)
+        try:
+            value = await compute()
+        except asyncio.CancelledError:
+            future.set_result(_MISSING)
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            future.exception()  # 没有等待方时不输出 "exception was never retrieved"
+            raise
+        finally:
+            del self._inflight[key]
+        future.set_result(value)
+        self._data[key] = (time.monotonic() + ttl, versions, value)
+        while len(self._data) > self.size:
+            self._data.popitem(last=False)
+        return value
+
+    def invalidate(self, tag):
+        """
+        使带有该标签的条目全部作废
+        """
+        self._versions[tag] = self._versions.get(tag, 0) + 1
+
+    def clear(self):
+        self._data.clear()
+
+    def stats(self):
+        return dict(size=len(self._data), hits=self.hits, misses=self.misses, coalesced=self.coalesced)
+
+
+result_cache = ResultCache()
+
+
+class DataLoader(object):
+    """
+    把同一轮事件循环中发起的多次 load(key) 合并成一次批量查询
+    同一个key只查询一次，结果在 DataLoader 的生命周期内（一个请求）复用
+    """
+
+    def __init__(self, batch_fn, max_batch_size=500):
+        """
+        :param batch_fn: 协程函数，参数为key列表，返回 key => value 的dict，缺失的key视为None
+        :param max_batch_size: 单次批量查询的key数量上限
+        """
+        self.batch_fn = batch_fn
+        self.max_batch_size = max_batch_size
+        self._futures = dict()  # key => future，已请求过的key
+        self._pending = []  # 本轮等待批量查询的key
+        self.batches = 0
+
+    def load(self, key):
+        """
+        :return: future，await 得到key对应的值
+        """
+        future = self._futures.get(key)
+        if future is None or future.cancelled():
+            # 被取消的 future 不能复用，重新查询
+            loop = asyncio.get_event_loop()
+            future = loop.create_future()
+            self._futures[key] = future
+            if not self._pending:
+                # 本轮中其他协程的 load 都会在 _dispatch 之前执行，从而被合并到同一批
+                loop.call_soon(self._dispatch)
+            self._pending.append(key)
+        return future
+
+    def clear(self, key):
+        """
+        丢弃已缓存的结果，下次 load 重新查询
+        """
+        future = self._futures.get(key)
+        if future is not None and future.done():
+            del self._futures[key]
+
+    def _dispatch(self):
+        keys, self._pending = self._pending, []
+        for i in range(0, len(keys), self.max_batch_size):
+            asyncio.ensure_future(self._fetch(keys[i:i + self.max_batch_size]))
+
+    async def _fetch(self, keys):
+        self.batches += 1
+        try:
+            values = await self.batch_fn(keys)
+        except Exception as e:
+            for key in keys:
+                # 查询失败的key不缓存，下次 load 重新查询
+                future = self._futures.pop(key)
+                if not future.done():
+                    future.set_exception(e)
+                    future.exception()  # 等待方都已取消时不输出 "exception was never retrieved"
+            return
+        for key in keys:
+            future = self._futures[key]
+            if not future.done():
+                future.set_result(values.get(key))
+
+
+@contextmanager
+def loader_scope():
+    """
+    在 with 块（通常是一个请求）中开启 find 的批量合并：
+    asyncio.gather(*[User.find(c.user_id) for c in comments]) 只会发出一条 where id in (...) 查询
+    """
+    token = _loaders.set(dict())
+    try:
+        yield
+    finally:
+        _loaders.reset(token)
+
+
+class WriteBehind(object):
+    """
+    计数器的延迟写入：Model.incr 只在内存中累加，同一行的多次累加合并，
+    定时或缓冲行数达到上限时，每行执行一条 update ... set `f`=`f`+? 写入数据库
+    """
+
+    def __init__(self, interval=1.0, max_rows=1000):
+        """
+        :param interval: 刷新间隔（秒）
+        :param max_rows: 缓冲的行数达到该值时立即刷新
+        """
+        self.interval = interval
+        self.max_rows = max_rows
+        self._pending = dict()  # (Model类, 主键) => {字段: 增量}
+        self._task = None
+        self._flushing = None
+
+    def incr(self, model, pk, field, n=1):
+        deltas = self._pending.get((model, pk))
+        if deltas is None:
+            deltas = self._pending[(model, pk)] = dict()
+        deltas[field] = deltas.get(field, 0) + n
+        if self._task is None or self._task.done():
+            self._task = self._spawn(self._run())
+        if len(self._pending) >= self.max_rows and self._flushing is None:
+            self._flushing = self._spawn(self._flush_in_task())
+
+    @staticmethod
+    def _spawn(coro):
+        # incr 通常在请求中调用，后台任务使用空的上下文，
+        # 不继承请求的连接、事务和 DataLoader（否则会一直持有它们缓存的数据）
+        return asyncio.get_event_loop().create_task(coro, context=contextvars.Context())
+
+    def pending(self):
+        """
+        :return: 尚未写入的行数
+        """
+        return len(self._pending)
+
+    async def flush(self):
+        """
+        把缓冲中的计数写入数据库，所有行在一个事务中提交
+        写入失败时增量合并回缓冲，下次再写
+        """
+        if not self._pending:
+            return
+        pending, self._pending = self._pending, dict()
+        try:
+            async with transaction():
+                for (model, pk), deltas in pending.items():
+                    await execute(model._incr_statement(tuple(sorted(deltas))),
+                                  [deltas[f] for f in sorted(deltas)] + [pk])
+        except Exception:
+            for key, deltas in pending.items():
+                current = self._pending.setdefault(key, dict())
+                for f, n in deltas.items():
+                    current[f] = current.get(f, 0) + n
+            raise
+        for model, pk in pending:
+            model._invalidate([pk])
+
+    async def _flush_in_task(self):
+        # 在单独的任务中刷新，不使用创建任务时所在请求固定的连接
+        _connection.set(None)
+        _in_transaction.set(False)
+        try:
+            await self.flush()
+        except Exception as e:
+            warning('failed to flush counters: %s' % e)
+        finally:
+            self._flushing = None
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            if self._flushing is None and self._pending:
+                self._flushing = self._spawn(self._flush_in_task())
+
+    async def close(self):
+        """
+        停止定时刷新，并把剩余的计数全部写入
+        """
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        if self._flushing is not None:
+            await self._flushing
+        await self.flush()
+
+
+write_behind = WriteBehind()
+
+
 class ModelMetaclass(type):
     """
     元类的主要目的就是为了当创建类时能够自动地改变类。
@@ -158,6 +879,44 @@ class ModelMetaclass(type):
 
         # 两个参数分别是表名，主键
         attrs['__delete__'] = 'delete from `%s` where `%s`=?' % (tableName, primaryKey)
+
+        # 在INSERT语句后追加 on duplicate key update，主键冲突时更新除主键外的字段
+        attrs['__upsert__'] = '%s on duplicate key update %s' % (
+            attrs['__insert__'], ', '.join(map(lambda f: '%s=values(%s)' % (f, f),
+                                                          escaped_fields or ['`%s`' % primaryKey])))
+
+        # 按主键查询
+        attrs['__find__'] = '%s where `%s`=?' % (attrs['__select__'], primaryKey)
+
+        # 类创建时就把占位符转换好，查询时不再做字符串处理
+        for k in ('__select__', '__insert__', '__update__', '__delete__', '__upsert__', '__find__'):
+            attrs[k] = attrs[k].replace('?', '%s')
+        # 紧凑记录类，列顺序与 __select__ 一致，供 findRecords 使用
+        attrs['__record__'] = make_record_class('%sRecord' % name, [primaryKey] + fields)
+        # 拼接好的 findAll/findNumber 语句缓存，key 为 (语句头, where, orderBy, limit形状)
+        attrs['__statements__'] = dict()
+        # 索引：字段上的 index/unique，以及 __indexes__ 中声明的组合索引，如 (('blog_id', 'created_at'),)
+        indexes = []
+        for k in fields:
+            field = mappings[k]
+            if field.unique or field.index:
+                indexes.append(('%s_%s_%s' % ('uk' if field.unique else 'idx', tableName, k), (k,), field.unique))
+        for columns in attrs.get('__indexes__', ()):
+            columns = tuple(columns)
+            for c in columns:
+                if c not in mappings:
+                    raise RuntimeError('Index field not found: %s' % c)
+            indexes.append(('idx_%s_%s' % (tableName, '_'.join(columns)), columns, False))
+        attrs['__index_list__'] = indexes  # [(索引名, 字段元组, 是否唯一)]
+        # findAll/findPage 默认不查询的字段，如 TextField(deferred=True)，需要时 await load_deferred() 加载
+        attrs['__deferred__'] = [k for k in fields if mappings[k].deferred]
+        # 按主键的读缓存，在Model子类中设置 __cache_size__ 开启，__cache_ttl__ 为过期时间（秒）
+        # 缓存只在写入的进程内失效，多进程部署时其他进程最长 __cache_ttl__ 秒后才能看到修改，默认不开启
+        cacheSize = attrs.get('__cache_size__', 0)
+        attrs['__cache__'] = LRUCache(cacheSize, attrs.get('__cache_ttl__', 60)) if cacheSize else None
+        # count() 的结果缓存，在Model子类中设置 __count_ttl__（秒）开启
+        countTTL = attrs.get('__count_ttl__', 0)
+        attrs['__count_cache__'] = LRUCache(256, countTTL) if countTTL else None
         return type.__new__(mcs, name, bases, attrs)
 
 
@@ -171,6 +930,9 @@ class Model(dict, metaclass=ModelMetaclass):
             return self[key]
             print(self.__primary_key__)
         except KeyError:
+            if key in self.__dict__.get('_unloaded', ()):
+                raise AttributeError(r"'%s' column '%s' is not loaded, await load_deferred() first"
+                                     % (self.__class__.__name__, key))
             raise AttributeError(r"'Model' object has no attribute '%s'" % key)
 
     def __setattr__(self, key, value):
@@ -181,6 +943,20 @@ class Model(dict, metaclass=ModelMetaclass):
         :return:
         """
         self[key] = value
+        unloaded = self.__dict__.get('_unloaded')
+        if unloaded and key in unloaded:
+            # 赋值后该列视为已加载，update 时会写入
+            object.__setattr__(self, '_unloaded', unloaded.difference((key,)) or None)
+
+    def _unloaded_columns(self):
+        """
+        尚未加载的列：查询时没有取出、之后也没有赋值（self.xxx 或 self['xxx']）的列
+        :return: frozenset 或 None
+        """
+        unloaded = self.__dict__.get('_unloaded')
+        if unloaded:
+            unloaded = unloaded.difference(self.keys())
+        return unloaded or None
 
     def getValue(self, key):
         """
@@ -204,90 +980,467 @@ class Model(dict, metaclass=ModelMetaclass):
                 setattr(self, key, value)
         return value
 
-    def sql_handle(self, sql, kw, where=None, args=None):
-        if where:
-            sql.append("where")
-            sql.append(where)
-        if args is None:
-            args = []
+    @classmethod
+    def sql_handle(cls, sql, kw, where=None, args=None):
+        """
+        拼接 where、order by、limit 子句
+        拼好的语句按 (语句头, where, orderBy, limit形状) 缓存在 __statements__ 中，
+        相同形状的查询只拼接一次
+        :param sql: 语句头，如 __select__
+        :param kw: 包含 orderBy、limit 的参数
+        :param where: where子句模板
+        :param args: where子句的参数
+        :return: (转换占位符后的sql语句, 参数列表)
+        """
         orderBy = kw.get('orderBy', None)
-        if orderBy:
-            sql.append("orderBy")
-            sql.append(orderBy)
         limit = kw.get("limit", None)
-        if limit is not None:
-            sql.append("limit")
-            if isinstance(limit, int):
-                sql.append('?')
-                args.append(limit)
-            elif isinstance(limit, tuple) and len(limit) == 2:
-                sql.append("?, ?")
-                args.extend((limit))
+        if limit is None:
+            shape = 0
+        elif isinstance(limit, int):
+            shape = 1
+        elif isinstance(limit, tuple) and len(limit) == 2:
+            shape = 2
+        else:
+            raise ValueError('Invalid limit value: %s' % str(limit))
+        key = (sql, where, orderBy, shape)
+        stmt = cls.__statements__.get(key)
+        if stmt is None:
+            L = [sql]
+            if where:
+                L.append("where")
+                L.append(where)
+            if orderBy:
+                L.append("order by")
+                L.append(orderBy)
+            if shape == 1:
+                L.append("limit ?")
+            elif shape == 2:
+                L.append("limit ?, ?")
+            stmt = ' '.join(L).replace('?', '%s')
+            if len(cls.__statements__) < STATEMENT_CACHE_SIZE:
+                cls.__statements__[key] = stmt
+        args = list(args) if args else []
+        if shape == 1:
+            args.append(limit)
+        elif shape == 2:
+            args.extend(limit)
+        return stmt, args
+
+    @classmethod
+    def _projection(cls, only=None, defer=None):
+        """
+        生成只查询部分列的语句头，结果缓存在 __statements__ 中
+        :param only: 只查询这些字段（主键总会查询）
+        :param defer: 不查询这些字段，在 __deferred__ 的基础上追加
+        :return: (select语句头, 未查询的字段集合)，查询全部列时集合为None
+        """
+        if only is None and not defer and not cls.__deferred__:
+            return cls.__select__, None
+        key = ('projection', tuple(only) if only is not None else None, tuple(defer) if defer else ())
+        item = cls.__statements__.get(key)
+        if item is None:
+            for f in list(only or ()) + list(defer or ()):
+                if f not in cls.__mappings__:
+                    raise ValueError('Invalid field: %s' % f)
+            if only is not None:
+                fields = [f for f in cls.__fields__ if f in only]
             else:
-                raise ValueError('Invalid limit value: %s' % str(limit))
-        return sql, args
+                skip = set(cls.__deferred__) | set(defer or ())
+                fields = [f for f in cls.__fields__ if f not in skip]
+            head = 'select %s from `%s`' % (
+                ', '.join('`%s`' % f for f in [cls.__primary_key__] + fields), cls.__table__)
+            item = (head, frozenset(cls.__fields__).difference(fields) or None)
+            if len(cls.__statements__) < STATEMENT_CACHE_SIZE:
+                cls.__statements__[key] = item
+        return item
 
     @classmethod
-    async def findAll(cls, where=None, args=None, **kw):
+    def _build(cls, rs, unloaded):
+        """
+        构造Model实例，有未查询的列时记录下来，并让同一批实例共享，供 load_deferred 批量加载
+        """
+        models = [cls(**r) for r in rs]
+        if unloaded:
+            for m in models:
+                # 不能用 self.xxx = 赋值，那样会写进dict里
+                object.__setattr__(m, '_unloaded', unloaded)
+                object.__setattr__(m, '_batch', models)
+        return models
+
+    @classmethod
+    async def findAll(cls, where=None, args=None, only=None, defer=None, cache_ttl=None, **kw):
         # find objects by where clause
-        sql = [cls.__select__]
+        # only/defer 指定只查询或不查询的字段，__deferred__ 中的字段默认不查询
+        # cache_ttl 不为空时结果缓存在 result_cache 中（秒），该Model有写操作时作废
+        head, unloaded = cls._projection(only, defer)
+        sql, args = cls.sql_handle(head, kw, where, args)
+        if cache_ttl and not _in_transaction.get():
+            rs = await result_cache.get_or_compute((sql, tuple(args)), (cls,), cache_ttl,
+                                                   lambda: select(sql, args))
+        else:
+            rs = await select(sql, args)
+
+        return cls._build(rs, unloaded)
+
+    async def load_deferred(self, *names):
+        """
+        加载查询时没有取出的列，与本实例同一次 findAll/findPage 得到的实例用一条查询一起加载
+        :param names: 要加载的字段，默认为全部未加载的字段
+        """
+        unloaded = self._unloaded_columns()
+        if not unloaded:
+            return
+        cls = self.__class__
+        names = [f for f in cls.__fields__ if f in unloaded and (not names or f in names)]
+        if not names:
+            return
+        batch = [m for m in self.__dict__.get('_batch', [self])
+                 if m.__dict__.get('_unloaded') and m.__dict__['_unloaded'].intersection(names)]
+        pk = cls.__primary_key__
+        head = 'select %s from `%s`' % (', '.join('`%s`' % f for f in [pk] + names), cls.__table__)
+        for i in range(0, len(batch), 500):
+            chunk = batch[i:i + 500]
+            where = '`%s` in (%s)' % (pk, create_args_string(len(chunk)))
+            sql, args = cls.sql_handle(head, {}, where, [m[pk] for m in chunk])
+            rows = dict((r[pk], r) for r in await select(sql, args))
+            for m in chunk:
+                r = rows.get(m[pk])
+                if r is not None:
+                    for f in names:
+                        # 已经赋过值的列保留新值
+                        if f not in m:
+                            m[f] = r[f]
+        for m in batch:
+            rest = m.__dict__['_unloaded'].difference(names).difference(m.keys())
+            object.__setattr__(m, '_unloaded', rest or None)
+            if not rest:
+                object.__setattr__(m, '_batch', None)
 
-        sql, args = cls.sql_handle(sql, kw, where, args)
+    @classmethod
+    async def findPage(cls, order_by='created_at', after=None, size=10, desc=True, where=None, args=None,
+                       only=None, defer=None):
+        """
+        键集（seek）分页：用上一页最后一行的 (order_by, 主键) 作为起点，
+        生成 where (`created_at`, `id`) < (?, ?) 查询，翻到多深都只扫描 size 行，
+        不像 limit offset, size 那样要先扫过前面所有的行
+        :param order_by: 排序字段，需要有 (order_by, 主键) 的索引
+        :param after: 上一页返回的游标，None 表示第一页
+        :param size: 每页条数，至少为1
+        :param desc: 是否倒序
+        :param only: 同 findAll
+        :param defer: 同 findAll
+        :return: (Model实例列表, 下一页游标)，没有下一页时游标为None
+        """
+        if order_by not in cls.__mappings__:
+            raise ValueError('Invalid order_by field: %s' % order_by)
+        if not isinstance(size, int) or size < 1:
+            raise ValueError('Invalid page size: %s' % size)
+        if only is not None and order_by not in only:
+            only = list(only) + [order_by]
+        pk = cls.__primary_key__
+        direction = 'desc' if desc else 'asc'
+        args = list(args) if args else []
+        if after is not None:
+            seek = '(`%s`, `%s`) %s (?, ?)' % (order_by, pk, '<' if desc else '>')
+            where = '(%s) and %s' % (where, seek) if where else seek
+            values = decode_cursor(after)
+            if not isinstance(values, list) or len(values) != 2:
+                raise ValueError('Invalid page cursor: %s' % str(after))
+            args.extend(values)
+        orderBy = '`%s` %s, `%s` %s' % (order_by, direction, pk, direction)
+        # 多取一行用来判断是否还有下一页
+        head, unloaded = cls._projection(only, defer)
+        sql, args = cls.sql_handle(head, dict(orderBy=orderBy, limit=size + 1), where, args)
+        rs = await select(sql, args)
+        items = cls._build(rs[:size], unloaded)
+        cursor = None
+        if len(rs) > size:
+            last = items[-1]
+            cursor = encode_cursor(last[order_by], last[pk])
+        return items, cursor
 
-        log(sql, args)
-        rs = await select(' '.join(sql), args)
+    @classmethod
+    async def findRecords(cls, where=None, args=None, **kw):
+        """
+        同 findAll，但用元组游标读取，每行构造为 __record__ 紧凑记录，
+        不再经过 dict 拷贝，适合只读的列表页
+        :return: __record__ 实例列表
+        """
+        sql, args = cls.sql_handle(cls.__select__, kw, where, args)
+        rs = await select(sql, args, tuples=True)
+        record = cls.__record__
+        return [record(*r) for r in rs]
 
-        return [cls(**r) for r in rs]
+    @classmethod
+    async def iter_all(cls, where=None, args=None, chunk_size=1000, **kw):
+        """
+        流式遍历查询结果，适用于导出和批处理等大结果集
+        用法：async for blog in Blog.iter_all(orderBy='created_at'): ...
+        注意：遍历期间会一直占用一个连接
+        :param chunk_size: 每次从数据库读取的条数
+        :return: 异步生成器，逐个产出Model实例
+        """
+        sql, args = cls.sql_handle(cls.__select__, kw, where, args)
+        async for rs in select_iter(sql, args, chunk_size):
+            for r in rs:
+                yield cls(**r)
 
     @classmethod
-    async def findNumber(cls, selectField, where=None, args=None, **kw):
-        # 找到选中的数及位置
-        sql = ['select %s _num_ from `%s`' % (selectField, cls.__table__)]
+    async def findNumber(cls, selectField, where=None, args=None):
+        # 找到选中的数，如 findNumber('count(id)')，直接返回数值（原来返回 [Model(_num_=数值)]）
+        # 聚合查询只有一行，不再接受 orderBy/limit
+        return await cls.aggregate(selectField, where=where, args=args)
 
-        sql, args = cls.sql_handle(sql, kw, where, args)
+    @classmethod
+    async def aggregate(cls, *exprs, where=None, args=None):
+        """
+        执行聚合查询，直接返回数值，不构造Model实例
+        用法：await Blog.aggregate('max(created_at)', where='user_id=?', args=[uid])
+        :param exprs: 聚合表达式，如 'count(id)'、'max(created_at)'
+        :return: 一个表达式时返回数值，多个时返回元组
+        """
+        sql = 'select %s from `%s`' % (', '.join(exprs), cls.__table__)
+        sql, args = cls.sql_handle(sql, {}, where, args)
+        rs = await select(sql, args, 1, tuples=True)
+        row = tuple(rs[0]) if rs else (None,) * len(exprs)
+        return row[0] if len(exprs) == 1 else row
 
-        rs = await select(' '.join(sql), args, 1)
-        return [cls(**r) for r in rs]
+    @classmethod
+    async def count(cls, where=None, args=None):
+        """
+        统计行数，设置了 __count_ttl__ 时结果按 (where, args) 缓存，该Model有写操作时清空
+        :return: 行数
+        """
+        cache = cls.__count_cache__ if not _in_transaction.get() else None
+        if cache is not None:
+            key = (where, tuple(args) if args else ())
+            n = cache.get(key)
+            if n is not None:
+                return n
+        n = await cls.aggregate('count(*)', where=where, args=args) or 0
+        if cache is not None:
+            cache.put(key, n)
+        return n
 
     @classmethod
     async def find(cls, pk):
-        # 通过主键找对象
-        rs = await select('%s where `%s`=?' % (cls.__select__, cls.__primary_key__), [pk], 1)
-        if len(rs) == 0:
+        # 通过主键找对象，开启了 __cache_size__ 时先查缓存
+        # 事务中读到的可能是未提交的数据，不走缓存
+        cache = cls.__cache__ if not _in_transaction.get() else None
+        if cache is not None:
+            r = cache.get(pk)
+            if r is not None:
+                # 返回副本，调用方修改实例不会污染缓存
+                return cls(**r)
+        loaders = _loaders.get()
+        if loaders is not None and _connection.get() is None:
+            # 在 loader_scope 中，与同一轮的其他 find 合并查询
+            loader = loaders.get(cls)
+            if loader is None:
+                loader = loaders[cls] = DataLoader(cls._find_many)
+            # shield：一个等待方被取消（超时、客户端断开）时不影响等待同一个key的其他协程
+            r = await asyncio.shield(loader.load(pk))
+        else:
+            rs = await select(cls.__find__, [pk], 1)
+            r = rs[0] if rs else None
+        if r is None:
             return None
-            return cls(**rs[0])
+        if cache is not None:
+            cache.put(pk, r)
+        return cls(**r)
+
+    @classmethod
+    async def _find_many(cls, pks):
+        """
+        按主键批量查询
+        :param pks: 主键列表
+        :return: 主键 => 行(dict)
+        """
+        where = '`%s` in (%s)' % (cls.__primary_key__, create_args_string(len(pks)))
+        sql, args = cls.sql_handle(cls.__select__, {}, where, pks)
+        rs = await select(sql, args)
+        pk = cls.__primary_key__
+        return dict((r[pk], r) for r in rs)
+
+    @classmethod
+    def incr(cls, pk, field, n=1):
+        """
+        给计数字段累加 n，先缓冲在内存中，由 write_behind 合并后批量写入
+        用法：Blog.incr(blog_id, 'views')
+        """
+        if field not in cls.__fields__:
+            raise ValueError('Invalid field: %s' % field)
+        write_behind.incr(cls, pk, field, n)
+
+    @classmethod
+    def _incr_statement(cls, fields):
+        """
+        :param fields: 字段元组
+        :return: update ... set `f`=`f`+? where pk=? 语句，结果缓存
+        """
+        key = ('incr', fields)
+        sql = cls.__statements__.get(key)
+        if sql is None:
+            sql = 'update `%s` set %s where `%s`=%%s' % (
+                cls.__table__, ', '.join('`%s`=`%s`+%%s' % (f, f) for f in fields), cls.__primary_key__)
+            cls.__statements__[key] = sql
+        return sql
+
+    @classmethod
+    def cache_stats(cls):
+        """
+        :return: 主键缓存的命中统计，未开启缓存时返回None
+        """
+        return cls.__cache__.stats() if cls.__cache__ is not None else None
+
+    @classmethod
+    def _invalidate(cls, pks):
+        """
+        写操作后使主键缓存、count缓存、findAll结果缓存和当前请求中 DataLoader 的结果失效
+        :param pks: 主键列表
+        """
+        pending = _pending_invalidations.get()
+        if pending is not None:
+            # 在事务中，等提交后再作废
+            pending.append((cls, list(pks)))
+            return
+        result_cache.invalidate(cls)
+        if cls.__count_cache__ is not None:
+            cls.__count_cache__.clear()
+        loaders = _loaders.get()
+        loader = loaders.get(cls) if loaders is not None else None
+        if cls.__cache__ is None and loader is None:
+            return
+        for pk in pks:
+            if cls.__cache__ is not None:
+                cls.__cache__.invalidate(pk)
+            if loader is not None:
+                loader.clear(pk)
 
     async def save(self):
         args = list(map(self.getValueOrDefault, self.__fields__))
         args.append(self.getValueOrDefault(self.__primary_key__))
         try:
             rows = await execute(self.__insert__, args)
+            self._invalidate(args[-1:])
             if rows != 1:
                 warning('failed to insert record: affected rows: %s' % rows)
-        except pymysql.err.IntegrityError:
+        except _backend.IntegrityError:
             warning('主键参数输入错误')
 
+    @classmethod
+    def _write_statement(cls, kind, unloaded):
+        """
+        :param kind: 'insert' 或 'upsert'
+        :param unloaded: 未加载的列，这些列不出现在 insert 的列和 on duplicate key update 中，避免写成NULL
+        :return: sql语句，参数顺序为已加载的字段、主键
+        """
+        if not unloaded:
+            return cls.__insert__ if kind == 'insert' else cls.__upsert__
+        sql = cls.__statements__.get((kind, unloaded))
+        if sql is None:
+            columns = ['`%s`' % f for f in cls.__fields__ if f not in unloaded]
+            sql = 'insert into `%s` (%s) values (%s)' % (
+                cls.__table__, ', '.join(columns + ['`%s`' % cls.__primary_key__]),
+                ', '.join(['%s'] * (len(columns) + 1)))
+            if kind == 'upsert':
+                sql = '%s on duplicate key update %s' % (sql, ', '.join(
+                    '%s=values(%s)' % (c, c) for c in columns or ['`%s`' % cls.__primary_key__]))
+            cls.__statements__[(kind, unloaded)] = sql
+        return sql
+
+    @classmethod
+    def _rows_args(cls, rows):
+        """
+        把多行数据转换为参数列表，按未加载的列分组（见 _write_statement）
+        :param rows: Model实例或dict组成的序列
+        :return: [(未加载的列, 参数列表)]，参数顺序与 _write_statement 的语句一致，最后一个是主键
+        """
+        groups = dict()
+        for row in rows:
+            if not isinstance(row, cls):
+                row = cls(**row)
+            unloaded = row._unloaded_columns()
+            fields = [f for f in cls.__fields__ if f not in unloaded] if unloaded else cls.__fields__
+            args = list(map(row.getValueOrDefault, fields))
+            args.append(row.getValueOrDefault(cls.__primary_key__))
+            groups.setdefault(unloaded or None, []).append(args)
+        return list(groups.items())
+
+    @classmethod
+    async def _write_many(cls, kind, rows, batch_size):
+        counts = []
+        total = 0
+        for unloaded, args_list in cls._rows_args(rows):
+            counts.extend(await execute_many(cls._write_statement(kind, unloaded), args_list, batch_size))
+            cls._invalidate(args[-1] for args in args_list)
+            total += len(args_list)
+        return counts, total
+
+    @classmethod
+    async def save_many(cls, rows, batch_size=500):
+        """
+        批量插入，分批通过同一个连接发送多行insert
+        :param rows: Model实例或dict组成的序列
+        :param batch_size: 每批次的行数
+        :return: 列表，每个批次影响的行数
+        """
+        counts, total = await cls._write_many('insert', rows, batch_size)
+        if sum(counts) != total:
+            warning('failed to insert records: affected rows: %s of %s' % (sum(counts), total))
+        return counts
+
+    @classmethod
+    async def upsert_many(cls, rows, batch_size=500):
+        """
+        批量插入或更新，主键已存在时更新其余字段，未加载的列（如 defer 的字段）保持原值
+        MySQL对每个被更新的行计为2，未变化的行计为0
+        :param rows: Model实例或dict组成的序列
+        :param batch_size: 每批次的行数
+        :return: 列表，每个批次影响的行数
+        """
+        counts, _ = await cls._write_many('upsert', rows, batch_size)
+        return counts
+
     async def update(self):
-        args = list(map(self.getValue, self.__fields__))
+        fields, sql = self.__fields__, self.__update__
+        unloaded = self._unloaded_columns()
+        if unloaded:
+            # 只更新已加载的列，避免把没查询出来的列写成NULL
+            fields = [f for f in fields if f not in unloaded]
+            if not fields:
+                return
+            sql = self.__statements__.get(('update', unloaded))
+            if sql is None:
+                sql = 'update `%s` set %s where `%s`=%%s' % (
+                    self.__table__, ', '.join('`%s`=%%s' % (self.__mappings__[f].name or f) for f in fields),
+                    self.__primary_key__)
+                self.__statements__[('update', unloaded)] = sql
+        args = list(map(self.getValue, fields))
         args.append(self.getValue(self.__primary_key__))
-        rows = await execute(self.__update__, args)
+        rows = await execute(sql, args)
+        self._invalidate(args[-1:])
         if rows != 1:
             warning('failed to update by primary key: affected rows: %s' % rows)
 
     async def remove(self):
         args = [self.getValue(self.__primary_key__)]
         rows = await execute(self.__delete__, args)
+        self._invalidate(args)
         if rows != 1:
             warning('failed to remove by primary key: affected rows: %s' % rows)
 
 
 class Field(object):
 
-    def __init__(self, name, column_type, primary_key, default):
+    def __init__(self, name, column_type, primary_key, default, index=False, unique=False):
         self.name = name
         self.column_type = column_type
         self.primary_key = primary_key
         self.default = default
+        self.index = index  # 是否为该列建普通索引
+        self.unique = unique  # 是否为该列建唯一索引
+        self.deferred = False  # findAll 时是否默认不查询该列
 
     def __str__(self):
         return '<%s, %s:%s>' % (self.__class__.__name__, self.column_type, self.name)
@@ -301,26 +1454,27 @@ include Fieldtype: String, Int, Boolean, Text
 
 class StringField(Field):
 
-    def __init__(self, name=None, primary_key=False, default=None, ddl='varchar(100)'):
-        super().__init__(name, ddl, primary_key, default)
+    def __init__(self, name=None, primary_key=False, default=None, ddl='varchar(100)', index=False, unique=False):
+        super().__init__(name, ddl, primary_key, default, index, unique)
 
 
 class IntegerField(Field):
 
-    def __init__(self, name=None, primary_key=False, default=0):
-        super().__init__(name, 'bigint', primary_key, default)
+    def __init__(self, name=None, primary_key=False, default=0, index=False, unique=False):
+        super().__init__(name, 'bigint', primary_key, default, index, unique)
 
 
 class BooleanField(Field):
-    def __init__(self, name=None, default=False):
-        super().__init__(name, 'boolean', False, default)
+    def __init__(self, name=None, default=False, index=False):
+        super().__init__(name, 'boolean', False, default, index)
 
 
 class TextField(Field):
-    def __init__(self, name=None, default=None):
+    def __init__(self, name=None, default=None, deferred=False):
         super().__init__(name, 'text', False, default)
+        self.deferred = deferred
 
 
 class FloatField(Field):
-    def __init__(self, name=None, primary_key=False, default=0):
-        super().__init__(name, 'real', primary_key, default)
+    def __init__(self, name=None, primary_key=False, default=0, index=False, unique=False):
+        super().__init__(name, 'real', primary_key, default, index, unique)
@@ -0,0 +1,99 @@
+import logging
+import random
+import re
+
+"""
+SQL执行统计与慢查询日志
+orm 中的 select/execute 每执行一条语句都会调用 query_stats.record()
+"""
+
+# 慢查询单独输出到 orm.slow，可在 logging 配置中写入单独的文件
+slow_log = logging.getLogger('orm.slow')
+
+_re_string = re.compile(r"'(?:[^'\\]|\\.)*'|\"(?:[^\"\\]|\\.)*\"")
+_re_number = re.compile(r'\b\d+(?:\.\d+)?\b')
+_re_in_list = re.compile(r'\bin\s*\((?:\s*(?:\?|%s)\s*,?)+\)', re.IGNORECASE)
+_re_space = re.compile(r'\s+')
+
+# 指纹缓存上限，Model 生成的SQL种类有限，正常情况下不会超过
+FINGERPRINT_CACHE_SIZE = 1024
+
+
+class QueryStats(object):
+    """
+    按SQL指纹汇总执行次数、耗时、行数和等待连接的时间
+    """
+
+    def __init__(self, slow_threshold=0.5, explain_rate=0.0):
+        """
+        :param slow_threshold: 慢查询阈值（秒），None 表示不记录慢查询
+        :param explain_rate: 慢 SELECT 中执行 EXPLAIN 的抽样比例，0~1
+        """
+        self.slow_threshold = slow_threshold
+        self.explain_rate = explain_rate
+        self._stats = dict()  # 指纹 => [次数, 总耗时, 最大耗时, 总行数, 总等待时间, 慢查询次数]
+        self._fingerprints = dict()
+
+    def fingerprint(self, sql):
+        """
+        归一化SQL：字面量替换为 ?，in (?, ?, ...) 合并为 in (...)，压缩空白并转小写
+        :param sql: sql语句
+        :return: 指纹
+        """
+        fp = self._fingerprints.get(sql)
+        if fp is None:
+            fp = _re_string.sub('?', sql)
+            fp = _re_number.sub('?', fp)
+            fp = _re_in_list.sub('in (...)', fp)
+            fp = _re_space.sub(' ', fp).strip().lower().replace('%s', '?')
+            if len(self._fingerprints) < FINGERPRINT_CACHE_SIZE:
+                self._fingerprints[sql] = fp
+        return fp
+
+    def record(self, sql, elapsed, wait=0.0, rows=0):
+        """
+        记录一次执行
+        :param sql: sql语句
+        :param elapsed: 执行耗时（秒），不含等待连接的时间
+        :param wait: 从连接池获取连接的等待时间（秒）
+        :param rows: 返回或影响的行数
+        :return: 是否为慢查询
+        """
+        fp = self.fingerprint(sql)
+        slow = self.slow_threshold is not None and elapsed >= self.slow_threshold
+        s = self._stats.get(fp)
+        if s is None:
+            s = self._stats[fp] = [0, 0.0, 0.0, 0, 0.0, 0]
+        s[0] += 1
+        s[1] += elapsed
+        s[2] = max(s[2], elapsed)
+        s[3] += rows
+        s[4] += wait
+        if slow:
+            s[5] += 1
+            slow_log.warning('slow query %.3fs (wait %.3fs, rows %s): %s' % (elapsed, wait, rows, sql))
+        return slow
+
+    def should_explain(self, sql):
+        """
+        :return: 是否对这条慢查询执行 EXPLAIN
+        """
+        return self.explain_rate > 0 and sql.lstrip()[:6].lower() == 'select' \
+            and random.random() < self.explain_rate
+
+    def top(self, n=10, key='total'):
+        """
+        :param n: 返回条数
+        :param key: 排序字段：count/total/max/rows/wait/slow
+        :return: 按 key 倒序的统计列表
+        """
+        items = [dict(sql=fp, count=s[0], total=s[1], avg=s[1] / s[0], max=s[2], rows=s[3], wait=s[4], slow=s[5])
+                 for fp, s in self._stats.items()]
+        items.sort(key=lambda item: item[key], reverse=True)
+        return items[:n]
+
+    def reset(self):
+        self._stats.clear()
+
+
+query_stats = QueryStats()
@@ -0,0 +1,104 @@
+from orm import select
+
+"""
+根据Model生成建表/建索引的DDL，并与数据库中已有的索引对比
+用法：python schema.py > schema.sql，SQLite：python schema.py sqlite > schema.sql
+"""
+
+
+def create_table_sql(model, dialect='mysql'):
+    """
+    :param model: Model子类
+    :param dialect: 'mysql' 或 'sqlite'
+    :return: CREATE TABLE 语句
+    """
+    pk = model.__primary_key__
+    lines = ['  `%s` %s not null' % (pk, model.__mappings__[pk].column_type)]
+    for f in model.__fields__:
+        lines.append('  `%s` %s' % (f, model.__mappings__[f].column_type))
+    lines.append('  primary key (`%s`)' % pk)
+    options = ' engine=innodb default charset=utf8' if dialect == 'mysql' else ''
+    return 'create table `%s` (\n%s\n)%s;' % (model.__table__, ',\n'.join(lines), options)
+
+
+def create_index_sql(model, name, columns, unique=False):
+    """
+    :param model: Model子类
+    :param name: 索引名
+    :param columns: 字段元组
+    :param unique: 是否唯一索引
+    :return: CREATE INDEX 语句
+    """
+    return 'create %sindex `%s` on `%s` (%s);' % (
+        'unique ' if unique else '', name, model.__table__, ', '.join('`%s`' % c for c in columns))
+
+
+def schema_sql(*models, dialect='mysql'):
+    """
+    :param models: Model子类
+    :param dialect: 'mysql' 或 'sqlite'
+    :return: 所有表和索引的DDL
+    """
+    L = []
+    for model in models:
+        L.append(create_table_sql(model, dialect))
+        for name, columns, unique in model.__index_list__:
+            L.append(create_index_sql(model, name, columns, unique))
+        L.append('')
+    return '\n'.join(L)
+
+
+async def load_indexes(dialect='mysql'):
+    """
+    读取当前库的索引，MySQL 从 information_schema 读取，SQLite 从 pragma 读取
+    :param dialect: 'mysql' 或 'sqlite'
+    :return: {表名: [(字段元组, 是否唯一)]}
+    """
+    if dialect == 'sqlite':
+        result = dict()
+        for t in await select("select name from sqlite_master where type = 'table'", None):
+            for idx in await select('pragma index_list(`%s`)' % t['name'], None):
+                columns = [r['name'] for r in await select('pragma index_info(`%s`)' % idx['name'], None)]
+                result.setdefault(t['name'], []).append((tuple(columns), bool(idx['unique'])))
+        return result
+    rs = await select('select table_name as tbl, index_name as idx, non_unique as nu, column_name as col '
+                      'from information_schema.statistics where table_schema = database() '
+                      'order by table_name, index_name, seq_in_index', None)
+    indexes = dict()
+    for r in rs:
+        indexes.setdefault((r['tbl'], r['idx']), [[], not r['nu']])[0].append(r['col'])
+    result = dict()
+    for (table, _), (columns, unique) in indexes.items():
+        result.setdefault(table, []).append((tuple(columns), unique))
+    return result
+
+
+async def missing_indexes(*models, dialect='mysql'):
+    """
+    对比Model声明的索引和数据库中已有的索引
+    已有索引的最左前缀包含声明的字段即视为已覆盖，唯一索引要求字段完全相同
+    :param models: Model子类
+    :param dialect: 'mysql' 或 'sqlite'
+    :return: 缺失的索引列表，每项为dict(table, name, columns, unique, ddl)
+    """
+    existing = await load_indexes(dialect)
+    missing = []
+    for model in models:
+        table_indexes = existing.get(model.__table__, [])
+        for name, columns, unique in model.__index_list__:
+            if unique:
+                covered = any(c == columns and u for c, u in table_indexes)
+            else:
+                covered = any(c[:len(columns)] == columns for c, u in table_indexes)
+            if not covered:
+                missing.append(dict(table=model.__table__, name=name, columns=columns, unique=unique,
+                                    ddl=create_index_sql(model, name, columns, unique)))
+    return missing
+
+
+if __name__ == '__main__':
+    import sys
+
+    from models import User, Blog, Comment
+
+    print(schema_sql(User, Blog, Comment, dialect=sys.argv[1] if len(sys.argv) > 1 else 'mysql'))
@@ -0,0 +1,155 @@
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+"""
+JSON 序列化：直接输出 utf-8 bytes，安装了 orjson 时使用 orjson，否则使用标准库 json
+Model 是 dict 的子类，两种编码器都直接序列化，不经过 default；
+orm.Record 等没有 __dict__ 的对象通过 to_dict() 转换
+用法：serializers.dumps(obj) => bytes，切换编码器：serializers.set_encoder('json')
+视图函数返回 json_array()/ndjson() 时逐条序列化并分块发送，见 app.response_factory
+"""
+
+# 流式输出时每批的条数和字节数上限，达到任一上限即发送
+STREAM_BATCH_SIZE = 100
+STREAM_BATCH_BYTES = 64 * 1024
+
+
+def default(obj):
+    """
+    编码器不认识的对象：有 to_dict() 的调用 to_dict()，否则取 __dict__
+    """
+    to_dict = getattr(obj, 'to_dict', None)
+    if to_dict is not None:
+        return to_dict()
+    try:
+        return obj.__dict__
+    except AttributeError:
+        raise TypeError('Object of type %s is not JSON serializable' % type(obj).__name__)
+
+
+class JSONEncoder(object):
+    """
+    标准库 json，输出与 orjson 相同的紧凑格式
+    """
+    name = 'json'
+
+    def __init__(self):
+        self._encoder = json.JSONEncoder(ensure_ascii=False, separators=(',', ':'), default=default)
+
+    def dumps(self, obj):
+        return self._encoder.encode(obj).encode('utf-8')
+
+
+class OrjsonEncoder(object):
+    """
+    orjson，C实现，直接生成 bytes；orjson 不支持的值（如超过64位的整数）回退到标准库 json
+    """
+    name = 'orjson'
+
+    def __init__(self):
+        if orjson is None:
+            raise ImportError('orjson is not installed')
+        self._option = orjson.OPT_NON_STR_KEYS
+        self._fallback = JSONEncoder()
+
+    def dumps(self, obj):
+        try:
+            return orjson.dumps(obj, default=default, option=self._option)
+        except orjson.JSONEncodeError:
+            return self._fallback.dumps(obj)
+
+
+ENCODERS = dict(json=JSONEncoder, orjson=OrjsonEncoder)
+
+
+def load_encoder(name=None):
+    """
+    :param name: 'orjson'、'json' 或编码器实例，None 表示有 orjson 时用 orjson
+    :return: 编码器
+    """
+    if name is None:
+        name = 'orjson' if orjson is not None else 'json'
+    if not isinstance(name, str):
+        return name
+    if name not in ENCODERS:
+        raise ValueError('Unknown JSON encoder: %s' % name)
+    return ENCODERS[name]()
+
+
+encoder = load_encoder()
+
+
+def set_encoder(name):
+    global encoder
+    encoder = load_encoder(name)
+
+
+def dumps(obj):
+    """
+    :return: utf-8 编码的 JSON bytes
+    """
+    return encoder.dumps(obj)
+
+
+class JSONStream(object):
+    """
+    逐条序列化的 JSON 数组或 NDJSON，异步迭代时产出 bytes 块
+    第一条单独发送，尽快返回首字节；之后按条数或字节数分批，内存占用只与批大小有关
+    """
+
+    def __init__(self, items, lines=False, batch_size=STREAM_BATCH_SIZE, batch_bytes=STREAM_BATCH_BYTES):
+        """
+        :param items: 可迭代对象或异步可迭代对象，如 Blog.iter_all()
+        :param lines: True 为 NDJSON（每行一条），False 为 JSON 数组
+        """
+        self.items = items
+        self.lines = lines
+        self.batch_size = batch_size
+        self.batch_bytes = batch_bytes
+        self.content_type = 'application/x-ndjson' if lines else 'application/json'
+
+    async def _iter_items(self):
+        if hasattr(self.items, '__aiter__'):
+            async for item in self.items:
+                yield item
+        else:
+            for item in self.items:
+                yield item
+
+    async def __aiter__(self):
+        buf = bytearray() if self.lines else bytearray(b'[')
+        count = 0
+        async for item in self._iter_items():
+            if self.lines:
+                buf += dumps(item)
+                buf += b'\n'
+            else:
+                if count:
+                    buf += b','
+                buf += dumps(item)
+            count += 1
+            if count == 1 or count % self.batch_size == 0 or len(buf) >= self.batch_bytes:
+                yield bytes(buf)
+                buf.clear()
+        if not self.lines:
+            buf += b']'
+        if buf:
+            yield bytes(buf)
+
+
+def json_array(items, batch_size=STREAM_BATCH_SIZE, batch_bytes=STREAM_BATCH_BYTES):
+    """
+    流式输出 JSON 数组，用法：return json_array(Blog.iter_all(orderBy='created_at'))
+    """
+    return JSONStream(items, False, batch_size, batch_bytes)
+
+
+def ndjson(items, batch_size=STREAM_BATCH_SIZE, batch_bytes=STREAM_BATCH_BYTES):
+    """
+    流式输出 NDJSON，每行一条
+    """
+    return JSONStream(items, True, batch_size, batch_bytes)
@@ -0,0 +1,263 @@
+import asyncio
+import re
+import sqlite3
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+"""
+SQLite 后端：在进程内访问数据库，不需要 MySQL 服务
+每个连接独占一个线程执行 sqlite3 调用，不阻塞事件循环；连接池/连接/游标的接口与 aiomysql 相同，
+orm 生成的 '%s' 占位符和 MySQL 专有的语法在这里转换
+用法：await orm.create_pool(loop, backend='sqlite', db='awesome.db')
+"""
+
+_re_upsert = re.compile(r'\s+on duplicate key update\s+(.*)$', re.IGNORECASE | re.DOTALL)
+_re_values = re.compile(r'values\((`?\w+`?)\)', re.IGNORECASE)
+
+# 转换后的SQL缓存：orm 的SQL => SQLite 的SQL
+_statements = dict()
+STATEMENT_CACHE_SIZE = 1024
+
+
+def convert_sql(sql):
+    """
+    把 orm 生成的SQL转换为 SQLite 的语法：
+    '%s' 占位符转换为 '?'，on duplicate key update `f`=values(`f`) 转换为 on conflict do update set `f`=excluded.`f`
+    反引号和 limit offset, count 两者都支持，不需要转换
+    :param sql: sql语句
+    :return: 转换后的sql语句
+    """
+    stmt = _statements.get(sql)
+    if stmt is None:
+        stmt = sql.replace('%s', '?')
+        m = _re_upsert.search(stmt)
+        if m:
+            stmt = '%s on conflict do update set %s' % (stmt[:m.start()], _re_values.sub(r'excluded.\1', m.group(1)))
+        if len(_statements) < STATEMENT_CACHE_SIZE:
+            _statements[sql] = stmt
+    return stmt
+
+
+class Cursor(object):
+    """
+    每行返回tuple的游标
+    """
+    dict_rows = False
+
+    def __init__(self, conn):
+        self._conn = conn
+        self._cur = None
+        self._names = None
+        self.rowcount = -1
+        self.description = None
+        self.arraysize = 1
+
+    def __await__(self):
+        # 兼容 cur = await conn.cursor() 的写法
+        yield from ()
+        return self
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    def _execute(self, method, sql, args):
+        cur = self._conn.db.cursor()
+        getattr(cur, method)(convert_sql(sql), args)
+        return cur
+
+    async def execute(self, sql, args=None):
+        self._cur = await self._conn.run(self._execute, 'execute', sql, tuple(args or ()))
+        self.rowcount = self._cur.rowcount
+        self.description = self._cur.description
+        self._names = [d[0] for d in self.description] if self.description else None
+        return self.rowcount
+
+    async def executemany(self, sql, args_list):
+        self._cur = await self._conn.run(self._execute, 'executemany', sql, [tuple(a) for a in args_list])
+        self.rowcount = self._cur.rowcount
+        self.description = None
+        return self.rowcount
+
+    def _rows(self, rows):
+        if not self.dict_rows:
+            return rows
+        names = self._names
+        return [dict(zip(names, r)) for r in rows]
+
+    async def fetchone(self):
+        rs = self._rows(await self._conn.run(self._cur.fetchmany, 1))
+        return rs[0] if rs else None
+
+    async def fetchmany(self, size=None):
+        return self._rows(await self._conn.run(self._cur.fetchmany, size or self.arraysize))
+
+    async def fetchall(self):
+        return self._rows(await self._conn.run(self._cur.fetchall))
+
+    async def close(self):
+        if self._cur is not None:
+            cur, self._cur = self._cur, None
+            await self._conn.run(cur.close)
+
+
+class DictCursor(Cursor):
+    """
+    每行返回dict的游标
+    """
+    dict_rows = True
+
+
+class Connection(object):
+
+    def __init__(self, db, executor):
+        self.db = db
+        self._executor = executor
+
+    async def run(self, fn, *args):
+        """
+        在连接独占的线程中执行 sqlite3 调用
+        """
+        return await asyncio.get_event_loop().run_in_executor(self._executor, fn, *args)
+
+    def cursor(self, cursorclass=Cursor):
+        return cursorclass(self)
+
+    async def begin(self):
+        await self.run(self.db.execute, 'begin')
+
+    async def commit(self):
+        await self.run(self.db.execute, 'commit')
+
+    async def rollback(self):
+        await self.run(self.db.execute, 'rollback')
+
+    async def close(self):
+        await self.run(self.db.close)
+        self._executor.shutdown(wait=False)
+
+
+class _PoolConnectionContext(object):
+
+    def __init__(self, pool):
+        self._pool = pool
+        self._conn = None
+
+    async def __aenter__(self):
+        self._conn = await self._pool._acquire()
+        return self._conn
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self._pool.release(self._conn)
+        self._conn = None
+
+
+class Pool(object):
+    """
+    SQLite 连接池，按需创建连接，最多 maxsize 个
+    文件数据库开启 WAL，读写可以并发；内存数据库每个连接是独立的库，只使用一个连接
+    """
+
+    def __init__(self, database, minsize=1, maxsize=10, timeout=5.0):
+        if database == ':memory:':
+            minsize = maxsize = 1
+        self.database = database
+        self.minsize = minsize
+        self.maxsize = maxsize
+        self.timeout = timeout
+        self.size = 0
+        self._free = deque()
+        self._waiters = deque()
+
+    @property
+    def freesize(self):
+        return len(self._free)
+
+    def _connect(self):
+        # isolation_level=None：与 autocommit=True 一致，事务由 begin/commit 显式控制
+        db = sqlite3.connect(self.database, timeout=self.timeout, isolation_level=None, check_same_thread=False)
+        if self.database != ':memory:':
+            db.execute('pragma journal_mode=wal')
+            db.execute('pragma synchronous=normal')
+        return db
+
+    async def _new_connection(self):
+        executor = ThreadPoolExecutor(max_workers=1)
+        db = await asyncio.get_event_loop().run_in_executor(executor, self._connect)
+        return Connection(db, executor)
+
+    async def fill(self):
+        while self.size < self.minsize:
+            self.size += 1
+            try:
+                self._free.append(await self._new_connection())
+            except BaseException:
+                self.size -= 1
+                raise
+
+    async def _acquire(self):
+        while True:
+            if self._free:
+                return self._free.popleft()
+            if self.size < self.maxsize:
+                self.size += 1
+                try:
+                    return await self._new_connection()
+                except BaseException:
+                    self.size -= 1
+                    raise
+            waiter = asyncio.get_event_loop().create_future()
+            self._waiters.append(waiter)
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                if waiter.done() and not waiter.cancelled():
+                    # 已被 release 唤醒，但在恢复执行前被取消：把唤醒让给下一个等待者，否则空闲连接没人取
+                    self._wakeup()
+                elif waiter in self._waiters:
+                    # 已被 _wakeup 跳过并移出队列时不用再删
+                    self._waiters.remove(waiter)
+                raise
+
+    def acquire(self):
+        return _PoolConnectionContext(self)
+
+    def release(self, conn):
+        self._free.append(conn)
+        self._wakeup()
+
+    def _wakeup(self):
+        # 唤醒一个仍在等待的协程
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                break
+
+    def close(self):
+        pass
+
+    async def wait_closed(self):
+        while self._free:
+            await self._free.popleft().close()
+            self.size -= 1
+
+
+class SQLiteBackend(object):
+    """
+    orm 的 SQLite 后端
+    """
+    name = 'sqlite'
+    explain = 'explain query plan'
+    IntegrityError = sqlite3.IntegrityError
+
+    def cursor_class(self, tuples=False, unbuffered=False):
+        # sqlite3 的游标本身就是逐行读取的，不需要单独的流式游标
+        return Cursor if tuples else DictCursor
+
+    async def create_pool(self, loop, kw):
+        pool = Pool(kw.get('db', ':memory:'), kw.get('minsize', 1), kw.get('maxsize', 10), kw.get('timeout', 5.0))
+        await pool.fill()
+        return pool
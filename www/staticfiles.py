@@ -0,0 +1,101 @@
+import hashlib
+import logging
+import mimetypes
+import os
+
+from aiohttp import web
+
+from compression import compressible, precompress_file
+
+"""
+静态文件：启动时计算内容哈希，构建时预压缩
+模板中用 {{ static_url('css/app.css') }} 得到 /static/css/app.<哈希>.css，内容不变则URL不变，
+带哈希的URL返回 Cache-Control: immutable，浏览器不再重新验证
+文件由 web.FileResponse 通过 sendfile 发送，客户端接受压缩时自动发送预压缩的 .br/.gz 文件
+构建时预压缩：python staticfiles.py [static目录]
+"""
+
+IMMUTABLE = 'public, max-age=31536000, immutable'
+HASH_LENGTH = 10
+
+
+def fingerprint(path):
+    """
+    :return: 文件内容的哈希
+    """
+    h = hashlib.blake2b(digest_size=HASH_LENGTH // 2)
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(64 * 1024), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def hashed_name(name, digest):
+    """
+    css/app.css => css/app.<digest>.css
+    """
+    root, ext = os.path.splitext(name)
+    return '%s.%s%s' % (root, digest, ext)
+
+
+class StaticAssets(object):
+
+    def __init__(self, path, prefix='/static/'):
+        """
+        :param path: 静态文件目录
+        :param prefix: URL前缀
+        """
+        self.path = os.path.abspath(path)
+        self.prefix = prefix
+        self._urls = dict()  # 相对路径 => 带哈希的相对路径
+        self._files = dict()  # 带哈希的相对路径 => 文件路径
+
+    def _walk(self):
+        for root, dirs, files in os.walk(self.path):
+            for filename in files:
+                # 跳过预压缩文件和隐藏文件（包括预压缩时写了一半的临时文件）
+                if filename.endswith('.gz') or filename.endswith('.br') or filename.startswith('.'):
+                    continue
+                path = os.path.join(root, filename)
+                yield os.path.relpath(path, self.path).replace(os.sep, '/'), path
+
+    def scan(self, precompress=False):
+        """
+        计算所有文件的哈希，可选为文本文件生成 .gz/.br
+        :param precompress: 是否预压缩，默认不压缩，由构建步骤 python staticfiles.py 生成
+        """
+        self._urls.clear()
+        self._files.clear()
+        written = 0
+        for name, path in self._walk():
+            hashed = hashed_name(name, fingerprint(path))
+            self._urls[name] = hashed
+            self._files[hashed] = path
+            if precompress and compressible(mimetypes.guess_type(path)[0] or ''):
+                written += len(precompress_file(path))
+        logging.info('static %s: %s files, %s precompressed' % (self.path, len(self._urls), written))
+
+    def url(self, name):
+        """
+        模板中使用的URL，未知的文件返回不带哈希的URL
+        """
+        return self.prefix + self._urls.get(name, name)
+
+    async def handle(self, request):
+        name = request.match_info['filename']
+        path = self._files.get(name)
+        if path is not None:
+            return web.FileResponse(path, headers={'Cache-Control': IMMUTABLE})
+        # 不带哈希的URL：文件可能变化，每次都要验证
+        path = os.path.abspath(os.path.join(self.path, name))
+        if not path.startswith(self.path + os.sep) or not os.path.isfile(path):
+            raise web.HTTPNotFound()
+        return web.FileResponse(path, headers={'Cache-Control': 'no-cache'})
+
+
+if __name__ == '__main__':
+    import sys
+
+    logging.basicConfig(level=logging.INFO)
+    StaticAssets(sys.argv[1] if len(sys.argv) > 1 else
+                 os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static')).scan(precompress=True)
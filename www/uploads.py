@@ -0,0 +1,225 @@
+import asyncio
+import functools
+import os
+import shutil
+import tempfile
+
+from aiohttp import web
+
+"""
+流式读取请求体和文件上传，请求体不整个读入内存：
+视图函数的命名关键字参数注解为 Upload 时，multipart 中的同名文件分块写入临时文件，传入 UploadedFile；
+注解为 BodyReader 时，传入请求体的流式读取器，由视图函数自己读取
+    @post('/api/users/{id}/image')
+    async def api_user_image(id, *, image: Upload(max_size=2 * 1024 * 1024, content_types=('image/',))):
+        image.save(path)
+临时文件在视图函数返回后删除，需要保留时调用 save()
+"""
+
+CHUNK_SIZE = 64 * 1024
+# 默认的单个文件、整个请求体、普通表单字段的大小上限（字节）
+MAX_FILE_SIZE = 10 * 1024 * 1024
+MAX_BODY_SIZE = 20 * 1024 * 1024
+MAX_FIELD_SIZE = 64 * 1024
+# 同时写临时文件的上传请求数，超过时后来的请求等待，期间不读取其连接上的数据，由TCP流量控制限速
+MAX_CONCURRENT = 16
+# 临时文件目录，None 为系统默认
+UPLOAD_DIR = None
+
+_slots = None
+
+
+def _semaphore():
+    global _slots
+    if _slots is None:
+        _slots = asyncio.Semaphore(MAX_CONCURRENT)
+    return _slots
+
+
+class Upload(object):
+    """
+    文件参数的注解，直接用 Upload 时使用默认限制
+    """
+
+    def __init__(self, max_size=MAX_FILE_SIZE, content_types=None):
+        """
+        :param max_size: 文件大小上限（字节）
+        :param content_types: 允许的 Content-Type 前缀，如 ('image/',)，None 为不限制
+        """
+        self.max_size = max_size
+        self.content_types = content_types
+
+    def accepts(self, content_type):
+        return self.content_types is None or any(content_type.startswith(t) for t in self.content_types)
+
+
+class UploadedFile(object):
+    """
+    已写入临时文件的上传文件
+    """
+
+    def __init__(self, name, filename, content_type, path, size):
+        self.name = name
+        self.filename = filename
+        self.content_type = content_type
+        self.path = path
+        self.size = size
+
+    def open(self, mode='rb'):
+        return open(self.path, mode)
+
+    def save(self, dest):
+        """
+        把临时文件移动到 dest，之后不再自动删除
+        """
+        shutil.move(self.path, dest)
+        self.path = None
+
+    def close(self):
+        if self.path is not None:
+            try:
+                os.remove(self.path)
+            except FileNotFoundError:
+                pass
+            self.path = None
+
+    def __repr__(self):
+        return '<UploadedFile %s %s (%s, %s bytes)>' % (self.name, self.filename, self.content_type, self.size)
+
+
+class BodyReader(object):
+    """
+    请求体的流式读取器，读取超过 max_size 时返回413
+        async for chunk in body:
+            ...
+    """
+
+    def __init__(self, request, max_size=MAX_BODY_SIZE, chunk_size=CHUNK_SIZE):
+        if request.content_length is not None and request.content_length > max_size:
+            raise web.HTTPRequestEntityTooLarge(max_size=max_size, actual_size=request.content_length)
+        self.request = request
+        self.max_size = max_size
+        self.chunk_size = chunk_size
+        self.size = 0
+
+    @property
+    def content_type(self):
+        return self.request.content_type
+
+    async def read_chunk(self):
+        """
+        :return: 下一块数据，读完时返回 b''
+        """
+        chunk = await self.request.content.read(self.chunk_size)
+        self.size += len(chunk)
+        if self.size > self.max_size:
+            raise web.HTTPRequestEntityTooLarge(max_size=self.max_size, actual_size=self.size)
+        return chunk
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        chunk = await self.read_chunk()
+        if not chunk:
+            raise StopAsyncIteration
+        return chunk
+
+    async def multipart(self):
+        """
+        :return: aiohttp 的 MultipartReader，逐个读取 part
+        """
+        return await self.request.multipart()
+
+    async def spool(self, name='body', filename=None):
+        """
+        把整个请求体写入临时文件
+        :return: UploadedFile
+        """
+        async with _semaphore():
+            return await _spool(self.read_chunk, name, filename, self.content_type, None)
+
+
+async def _spool(read_chunk, name, filename, content_type, max_size):
+    """
+    分块读取并写入临时文件，文件写入在线程池中执行，不阻塞事件循环
+    """
+    loop = asyncio.get_event_loop()
+    fd, path = tempfile.mkstemp(prefix='upload-', dir=UPLOAD_DIR)
+    size = 0
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            while True:
+                chunk = await read_chunk()
+                if not chunk:
+                    break
+                size += len(chunk)
+                if max_size is not None and size > max_size:
+                    raise web.HTTPRequestEntityTooLarge(max_size=max_size, actual_size=size)
+                await loop.run_in_executor(None, f.write, chunk)
+    except BaseException:
+        os.remove(path)
+        raise
+    return UploadedFile(name, filename, content_type, path, size)
+
+
+async def read_multipart(request, uploads, max_body=MAX_BODY_SIZE):
+    """
+    流式解析 multipart/form-data，文件写入临时文件，普通字段读入内存
+    :param request: 请求
+    :param uploads: {参数名: Upload}，只接受这些字段的文件
+    :param max_body: 整个请求体的大小上限
+    :return: {字段名: str 或 UploadedFile}，重复的字段取第一个
+    """
+    body = BodyReader(request, max_body)
+    params = dict()
+    async with _semaphore():
+        try:
+            reader = await body.multipart()
+            while True:
+                part = await reader.next()
+                if part is None:
+                    break
+                if part.filename is None:
+                    if part.name in uploads:
+                        raise web.HTTPBadRequest(text='Expected file field: %s' % part.name)
+                    value = bytearray()
+                    while True:
+                        chunk = await _read_part(body, part)
+                        if not chunk:
+                            break
+                        value.extend(chunk)
+                        if len(value) > MAX_FIELD_SIZE:
+                            raise web.HTTPRequestEntityTooLarge(max_size=MAX_FIELD_SIZE, actual_size=len(value))
+                    params.setdefault(part.name, value.decode(part.get_charset('utf-8')))
+                    continue
+                upload = uploads.get(part.name)
+                if upload is None or part.name in params:
+                    raise web.HTTPBadRequest(text='Unexpected file field: %s' % part.name)
+                content_type = part.headers.get('Content-Type', 'application/octet-stream')
+                if not upload.accepts(content_type):
+                    raise web.HTTPBadRequest(text='Unsupported file type: %s' % content_type)
+                params[part.name] = await _spool(functools.partial(_read_part, body, part),
+                                                 part.name, part.filename, content_type, upload.max_size)
+        except BaseException:
+            close_uploads(params)
+            raise
+    return params
+
+
+async def _read_part(body, part):
+    # 读取 part 的下一块，同时计入整个请求体的大小
+    chunk = await part.read_chunk(CHUNK_SIZE)
+    body.size += len(chunk)
+    if body.size > body.max_size:
+        raise web.HTTPRequestEntityTooLarge(max_size=body.max_size, actual_size=body.size)
+    return chunk
+
+
+def close_uploads(kwargs):
+    """
+    删除 kwargs 中未保存的临时文件
+    """
+    for value in kwargs.values():
+        if isinstance(value, UploadedFile):
+            value.close()